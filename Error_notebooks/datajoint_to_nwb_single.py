@@ -18,14 +18,15 @@ from pynwb import NWBFile, TimeSeries, NWBHDF5IO
 from pynwb.image import ImageSeries
 from pynwb.ophys import TwoPhotonSeries, OpticalChannel, ImageSegmentation, \
     Fluorescence, CorrectedImageStack, MotionCorrection, RoiResponseSeries, DfOverF
-import scanreader
+# scan_utils lives at the repository root, which must be importable (see README)
+from scan_utils import LazyScan
 
 # ============================== SET CONSTANTS ==========================================
 zero_zero_time = datetime.strptime('00:00:00', '%H:%M:%S').time()  # no precise time available
 institution = 'DataJoint - testing CorrectedImageStack'
 
-single_tiff_file = scanreader.read_scan('./k53_20160530_RSM_125um_41mW_zoom2p2_00001_00001.tif')
-add_tiff_file = scanreader.read_scan('./k53_20160530_RSM_125um_41mW_zoom2p2_00001_00001.tif')
+single_tiff_file = LazyScan('./k53_20160530_RSM_125um_41mW_zoom2p2_00001_00001.tif')
+add_tiff_file = LazyScan('./k53_20160530_RSM_125um_41mW_zoom2p2_00001_00001.tif')
 tiff_files = [single_tiff_file, add_tiff_file]
 
 def get_nwb_subject(session_key):
@@ -0,0 +1,143 @@
+import gc
+import os
+import pathlib
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from nwb_zarr import ZARR_SUFFIX, store_bytes
+
+
+# ==========================================================================
+# ----------------------- Parallel export across sessions ------------------
+# ==========================================================================
+
+def export_session(export_fn, session_key, output_dir, overwrite, export_kwargs):
+    # runs inside a worker: every session opens and closes its own NWBHDF5IO handle
+    start = time.perf_counter()
+    result = {'session_key': session_key, 'status': 'ok', 'output_fp': None, 'bytes': 0, 'error': None}
+    try:
+        nwbfile = export_fn(session_key, output_dir=output_dir, overwrite=overwrite, **export_kwargs)
+        if nwbfile is None:
+            # the file already existed (overwrite=False) or was up to date
+            result['status'] = 'skipped'
+        else:
+            suffix = ZARR_SUFFIX if export_kwargs.get('backend') == 'zarr' else '.nwb'
+            output_fp = pathlib.Path(output_dir).absolute() / ''.join([nwbfile.identifier, suffix])
+            result['output_fp'] = output_fp.as_posix()
+            result['bytes'] = store_bytes(output_fp) if output_fp.exists() else 0
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+    # the session's containers hold its arrays in reference cycles, which large arrays alone never get
+    # collected for: the worker's next session would start with them still in memory
+    nwbfile = None
+    gc.collect()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def run_parallel_export(export_fn, session_keys, output_dir='./', overwrite=True, num_workers=None,
+                        size_fn=None, memory_fn=None, max_memory_bytes=None, session_kwargs_fn=None, **export_kwargs):
+    # largest sessions are started first; a session is only started while the estimated memory of all
+    # running sessions stays below max_memory_bytes (one session always runs, whatever its estimate).
+    # session_kwargs_fn(session_key) returns extra export keyword arguments of one session (e.g. its metadata)
+    num_workers = num_workers or os.cpu_count()
+    size_fn = size_fn or (lambda session_key: 0)
+    memory_fn = memory_fn or size_fn
+    pending = sorted(session_keys, key=size_fn, reverse=True)
+    pending = [(i, session_key, memory_fn(session_key)) for i, session_key in enumerate(pending)]
+
+    results = []
+    # a worker that dies (killed for memory, segfault) breaks the whole pool and every running session
+    # fails with it. The sessions that were running are retried in a new pool, each alone (suspects), so
+    # only the session whose worker dies again while running alone is reported as failed
+    suspects = set()
+    start = time.perf_counter()
+    while pending:
+        running = {}
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        try:
+            while pending or running:
+                pending = start_sessions(executor, pending, running, suspects, num_workers, max_memory_bytes,
+                                         export_fn, output_dir, overwrite, session_kwargs_fn, export_kwargs)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results.append(session_result(future, running[future][1]))
+                    del running[future]
+        except BrokenProcessPool as e:
+            # sessions that finished before the pool broke keep their results
+            for future, (i, session_key, memory) in list(running.items()):
+                if future.done() and not isinstance(future.exception(), BrokenProcessPool):
+                    results.append(session_result(future, session_key))
+                    del running[future]
+            in_flight = list(running.values())
+            if len(in_flight) == 1:
+                i, session_key, _ = in_flight[0]
+                print(f'\tfailed (worker died): {session_key}')
+                results.append(failed_result(session_key, e))
+            elif in_flight:
+                print(f'\tworker died, retrying {len(in_flight)} running session(s) one at a time')
+                suspects.update(i for i, _, _ in in_flight)
+                pending = in_flight + pending
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    summary = summarize_results(results, time.perf_counter() - start)
+    print(f'Exported {summary["succeeded"]}/{summary["sessions"]} sessions in {summary["seconds"]:.1f}s '
+          f'({summary["sessions_per_s"]:.2f} sessions/s, {summary["gb_per_s"]:.3f} GB/s)')
+    return results, summary
+
+
+def start_sessions(executor, pending, running, suspects, num_workers, max_memory_bytes,
+                   export_fn, output_dir, overwrite, session_kwargs_fn, export_kwargs):
+    # submits what fits next to the running sessions, returns the sessions still pending; suspects
+    # only run alone. Raises BrokenProcessPool when the pool broke since the last wait
+    in_use = sum(memory for _, _, memory in running.values())
+    for n, (i, session_key, memory) in enumerate(pending):
+        if len(running) >= num_workers or any(j in suspects for j, _, _ in running.values()):
+            break
+        if running and (i in suspects or (max_memory_bytes is not None and in_use + memory > max_memory_bytes)):
+            continue
+        session_kwargs = dict(export_kwargs, **session_kwargs_fn(session_key)) if session_kwargs_fn \
+            else export_kwargs
+        try:
+            future = executor.submit(export_session, export_fn, session_key, output_dir, overwrite,
+                                     session_kwargs)
+        except BrokenProcessPool:
+            pending[:] = [item for item in pending if item is not None]
+            raise
+        running[future] = (i, session_key, memory)
+        in_use += memory
+        pending[n] = None
+    return [item for item in pending if item is not None]
+
+
+def session_result(future, session_key):
+    # BrokenProcessPool is left to run_parallel_export, other errors fail the session
+    try:
+        result = future.result()
+    except BrokenProcessPool:
+        raise
+    except Exception as e:
+        result = failed_result(session_key, e)
+    print(f'\t{result["status"]}: {session_key}')
+    return result
+
+
+def failed_result(session_key, error):
+    return {'session_key': session_key, 'status': 'failed', 'output_fp': None, 'bytes': 0,
+            'error': repr(error), 'seconds': None}
+
+
+def summarize_results(results, seconds):
+    total_bytes = sum(result['bytes'] for result in results)
+    return {'sessions': len(results),
+            'succeeded': sum(result['status'] == 'ok' for result in results),
+            'skipped': sum(result['status'] == 'skipped' for result in results),
+            'failed': sum(result['status'] == 'failed' for result in results),
+            'bytes': total_bytes,
+            'seconds': seconds,
+            'sessions_per_s': len(results) / seconds if seconds else 0.,
+            'gb_per_s': total_bytes / 1e9 / seconds if seconds else 0.}
@@ -0,0 +1,191 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+from functools import partial
+
+import numpy as np
+from dateutil.tz import tzlocal
+
+from export_stats import PeakMemorySampler, load_records
+from motioncorrect_timestamp_errors import default_metadata, export_to_nwb, plane_segmentation
+
+# ==========================================================================
+# ---------------- Synthetic-scale benchmark of the NWB export -------------
+# ==========================================================================
+# Runs export_to_nwb itself on synthetic scans (no tiffs needed) and synthetic segmentations of rois
+# ROIs of pixels_per_roi pixels, and reports the per-stage records of the export (wall and CPU time, peak memory delta, bytes written) with the write bandwidth, and
+# the wall time and peak RSS of the whole export.
+#
+#   python benchmark_export.py --planes 3 --output bench.json
+#   python benchmark_export.py --planes 3 --baseline bench.json   # exits 1 on regressions
+#
+# A baseline is only compared to a run of the same config; a different config exits with status 2.
+
+# the example's shapes: traces and shifts of 26100 frames, the placeholder corrected stack unless
+# stream_corrected=True reads all frames of the scan
+DEFAULT_CONFIG = {'planes': 2,
+                  'rois': 170,
+                  'pixels_per_roi': 313,
+                  'frames': 26100,
+                  'height': 256,
+                  'width': 265,
+                  'block_size': 100,
+                  # any other export_to_nwb keyword argument, e.g. {'embed_raw': True}
+                  'export_options': {'storage_policy': None, 'dtype_policy': None}}
+
+
+class SyntheticScan:
+    # scanreader-like scan whose frames are generated on demand, reproducible per frame block
+    def __init__(self, num_frames, height, width, fps=30.):
+        self.num_frames = num_frames
+        self.num_scanning_depths = self.num_fields = 1
+        self.num_channels = 1
+        self.field_heights = [height]
+        self.field_widths = [width]
+        self.fps = fps
+        self.filenames = []
+
+    def __getitem__(self, key):
+        field, ys, xs, channel, frames = key
+        frames = range(self.num_frames)[frames]
+        rng = np.random.default_rng(frames.start)
+        block = rng.integers(0, 2 ** 12, size=(self.field_heights[0], self.field_widths[0], len(frames)),
+                             dtype=np.int16)
+        return block[ys, xs]
+
+
+def synthetic_metadata(num_planes):
+    # the example's session and subject with num_planes planes
+    metadata = default_metadata('synthetic')
+    plane_key = metadata['plane_keys'][0]
+    metadata['plane_keys'] = [dict(plane_key, center_plane=center_plane) for center_plane in range(num_planes)]
+    return metadata
+
+
+def run_benchmark(config=None, output_dir=None):
+    config = dict(copy.deepcopy(DEFAULT_CONFIG), **(config or {}))
+    scans = [SyntheticScan(config['frames'], config['height'], config['width']) for _ in range(config['planes'])]
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        stats_path = os.path.join(tmp_dir, 'stats.jsonl')
+        start = time.perf_counter()
+        with PeakMemorySampler() as memory:
+            nwbfile = export_to_nwb('synthetic', output_dir=tmp_dir, metadata=synthetic_metadata(config['planes']),
+                                    scans=scans, corrected_block_size=config['block_size'], stats_path=stats_path,
+                                    segmentation=partial(plane_segmentation, num_rois=config['rois'],
+                                                         pixels_per_roi=config['pixels_per_roi']),
+                                    **config['export_options'])
+        seconds = time.perf_counter() - start
+        file_bytes = os.path.getsize(os.path.join(tmp_dir, nwbfile.identifier + '.nwb'))
+        record, = load_records(stats_path)
+    stages = record['stages']
+    for stage in stages.values():
+        stage['write_bandwidth_bytes_per_s'] = stage['bytes_written'] / stage['seconds'] \
+            if stage['bytes_written'] and stage['seconds'] else 0.
+    return {'config': config,
+            'stages': stages,
+            'total': {'seconds': seconds,
+                      'peak_rss_bytes': memory.peak_rss,
+                      'peak_rss_delta_bytes': memory.peak_delta,
+                      'bytes_written': file_bytes},
+            'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                            'cpu_count': os.cpu_count()},
+            'created': datetime.now(tzlocal()).isoformat()}
+
+
+def config_differences(results, baseline):
+    # config keys whose values differ, compared as stored in JSON
+    config = json.loads(json.dumps(results['config']))
+    reference = baseline.get('config', {})
+    return sorted(key for key in set(config) | set(reference) if config.get(key) != reference.get(key))
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    # a stage regresses when its wall time or peak memory grows by more than tolerance over the baseline;
+    # runs of different configs measure different work and are not compared
+    differences = config_differences(results, baseline)
+    if differences:
+        raise ValueError(f'The baseline was recorded with a different config ({", ".join(differences)})')
+    regressions = []
+    for name, stage in results['stages'].items():
+        reference = baseline['stages'].get(name)
+        if reference is None:
+            continue
+        for metric in ('seconds', 'peak_memory_delta_bytes'):
+            if reference.get(metric) and stage[metric] > reference[metric] * (1 + tolerance):
+                regressions.append({'stage': name, 'metric': metric, 'baseline': reference[metric],
+                                    'value': stage[metric], 'ratio': stage[metric] / reference[metric]})
+    return regressions
+
+
+def print_results(results):
+    print(f'{"stage":<20}{"seconds":>10}{"cpu s":>10}{"peak mem MB":>14}{"written MB":>12}{"MB/s":>10}')
+    for name, stage in results['stages'].items():
+        print(f'{name:<20}{stage["seconds"]:>10.2f}{stage["cpu_seconds"]:>10.2f}'
+              f'{stage["peak_memory_delta_bytes"] / 1e6:>14.1f}{stage["bytes_written"] / 1e6:>12.1f}'
+              f'{stage["write_bandwidth_bytes_per_s"] / 1e6:>10.1f}')
+    total = results['total']
+    print(f'{"export":<20}{total["seconds"]:>10.2f}{"":>10}{total["peak_rss_delta_bytes"] / 1e6:>14.1f}'
+          f'{total["bytes_written"] / 1e6:>12.1f}')
+
+
+def parse_option(text):
+    # NAME=VALUE, VALUE parsed as JSON when it is valid JSON (true, 3, "x", {...}), else kept as a string
+    name, _, value = text.partition('=')
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Synthetic-scale benchmark of the NWB export')
+    parser.add_argument('--planes', type=int, default=DEFAULT_CONFIG['planes'])
+    parser.add_argument('--rois', type=int, default=DEFAULT_CONFIG['rois'])
+    parser.add_argument('--pixels-per-roi', type=int, default=DEFAULT_CONFIG['pixels_per_roi'])
+    parser.add_argument('--frames', type=int, default=DEFAULT_CONFIG['frames'])
+    parser.add_argument('--height', type=int, default=DEFAULT_CONFIG['height'])
+    parser.add_argument('--width', type=int, default=DEFAULT_CONFIG['width'])
+    parser.add_argument('--block-size', type=int, default=DEFAULT_CONFIG['block_size'])
+    parser.add_argument('--storage-policy', default=None)
+    parser.add_argument('--dtype-policy', default=None)
+    parser.add_argument('--option', type=parse_option, action='append', default=[], metavar='NAME=VALUE',
+                        help='extra export_to_nwb keyword argument, e.g. --option embed_raw=true')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    export_options = dict(DEFAULT_CONFIG['export_options'], storage_policy=args.storage_policy,
+                          dtype_policy=args.dtype_policy, **dict(args.option))
+    results = run_benchmark({'planes': args.planes, 'rois': args.rois, 'pixels_per_roi': args.pixels_per_roi,
+                             'frames': args.frames, 'height': args.height, 'width': args.width,
+                             'block_size': args.block_size, 'export_options': export_options})
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        try:
+            regressions = compare_to_baseline(results, baseline, tolerance=args.tolerance)
+        except ValueError as e:
+            print(f'BASELINE MISMATCH {e}, not compared')
+            return 2
+        if baseline.get('environment') != results['environment']:
+            print(f'NOTE the baseline ran on {baseline.get("environment")}')
+        for regression in regressions:
+            print(f'REGRESSION {regression["stage"]} {regression["metric"]}: '
+                  f'{regression["value"]:.3g} vs {regression["baseline"]:.3g} ({regression["ratio"]:.2f}x)')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+import copy
+import time
+import uuid
+
+import h5py
+import numpy as np
+from hdmf.data_utils import GenericDataChunkIterator
+
+from nwb_storage import STORAGE_PRESETS, resolve_chunks, resolve_storage_policy
+
+try:
+    import hdf5plugin
+except ImportError:
+    # Blosc / Zstd filters are only offered when hdf5plugin is installed
+    hdf5plugin = None
+
+
+# ==========================================================================
+# ------------------------ Compression codec selection ---------------------
+# ==========================================================================
+# With codec_goal, a sample of chunks of each large dataset of a plane is trial-compressed in
+# memory with every candidate codec. The codec that best meets the goal replaces the compression
+# of that role in the plane's storage policy:
+#   'size'  : fewest stored bytes
+#   'write' : shortest encode time + time to write the stored bytes at disk_bytes_per_s
+#   'read'  : shortest decode time + time to read the stored bytes at disk_bytes_per_s
+# The choice and all measurements are stored in the file (scratch/codec_selection_<center_plane>).
+
+CODEC_GOALS = ('size', 'write', 'read')
+
+# plane data key -> storage policy role
+CODEC_ROLES = {'raw': 'raw',
+               'corrected': 'corrected',
+               'xy_translation': 'xy_translation',
+               'raw_fluo_traces': 'roi_response'}
+
+# chunks used when the storage policy does not chunk a role (compression needs chunks)
+DEFAULT_CHUNKS = {role: options['chunks'] for role, options in STORAGE_PRESETS['per_frame_reads'].items()}
+
+
+def candidate_codecs():
+    codecs = {'none': {},
+              'lzf': dict(compression='lzf', shuffle=True),
+              'gzip-1': dict(compression='gzip', compression_opts=1, shuffle=True),
+              'gzip-4': dict(compression='gzip', compression_opts=4, shuffle=True),
+              'gzip-9': dict(compression='gzip', compression_opts=9, shuffle=True)}
+    if hdf5plugin is not None:
+        codecs['zstd-3'] = dict(hdf5plugin.Zstd(clevel=3))
+        codecs['blosc-lz4-5'] = dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        codecs['blosc-zstd-5'] = dict(hdf5plugin.Blosc(cname='zstd', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    return codecs
+
+
+def sample_chunks(data, chunk_shape, max_chunks=8):
+    # whole chunks spread evenly along the first axis, stacked along it
+    shape = data.maxshape if isinstance(data, GenericDataChunkIterator) else data.shape
+    num_chunks = -(-shape[0] // chunk_shape[0])
+    starts = np.unique(np.linspace(0, num_chunks - 1, min(max_chunks, num_chunks)).astype(int)) * chunk_shape[0]
+    blocks = []
+    for start in starts:
+        selection = (slice(start, min(start + chunk_shape[0], shape[0])),) + tuple(slice(0, size) for size in shape[1:])
+        block = data._get_data(selection) if isinstance(data, GenericDataChunkIterator) else data[selection]
+        blocks.append(np.asarray(block))
+    return np.concatenate(blocks)
+
+
+def measure_codec(sample, chunk_shape, options):
+    # encode and decode in an in-memory HDF5 file, so only the filter cost is measured; core files
+    # are still registered by name, planes prepared concurrently need distinct ones
+    with h5py.File(f'codec_trial_{uuid.uuid4().hex}', 'w', driver='core', backing_store=False) as f:
+        start = time.perf_counter()
+        dset = f.create_dataset('trial', data=sample, chunks=resolve_chunks(chunk_shape, sample.shape), **options)
+        f.flush()
+        write_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        dset[...]
+        read_seconds = time.perf_counter() - start
+        stored_bytes = dset.id.get_storage_size()
+    return {'raw_bytes': int(sample.nbytes),
+            'stored_bytes': int(stored_bytes),
+            'ratio': sample.nbytes / stored_bytes if stored_bytes else 0.,
+            'write_seconds': write_seconds,
+            'read_seconds': read_seconds}
+
+
+def codec_cost(measurement, goal, disk_bytes_per_s):
+    if goal == 'size':
+        return measurement['stored_bytes']
+    io_seconds = measurement['stored_bytes'] / disk_bytes_per_s
+    if goal == 'write':
+        return measurement['write_seconds'] + io_seconds
+    return measurement['read_seconds'] + io_seconds
+
+
+def select_codec(data, chunk_shape, goal, disk_bytes_per_s=200e6, max_chunks=8):
+    if goal not in CODEC_GOALS:
+        raise ValueError(f'Unknown codec goal {goal!r}, choose one of {CODEC_GOALS}')
+    sample = sample_chunks(data, chunk_shape, max_chunks=max_chunks)
+    codecs = candidate_codecs()
+    measurements = {name: measure_codec(sample, chunk_shape, options) for name, options in codecs.items()}
+    best = min(measurements, key=lambda name: codec_cost(measurements[name], goal, disk_bytes_per_s))
+    return best, codecs[best], measurements
+
+
+def with_default_chunks(policy, roles):
+    # compression needs chunked datasets; roles without chunks get DEFAULT_CHUNKS
+    policy = copy.deepcopy(resolve_storage_policy(policy))
+    for role in roles:
+        options = policy.setdefault(role, {})
+        if options.get('chunks') is None:
+            options['chunks'] = DEFAULT_CHUNKS[role]
+    return policy
+
+
+def select_plane_codecs(data, policy, goal, disk_bytes_per_s=200e6):
+    # returns the plane's storage policy with the chosen codecs and the selection record
+    policy = copy.deepcopy(policy)
+    selection = {'goal': goal, 'disk_bytes_per_s': disk_bytes_per_s, 'datasets': {}}
+    for name, role in CODEC_ROLES.items():
+        if name not in data:
+            continue
+        shape = data[name].maxshape if isinstance(data[name], GenericDataChunkIterator) else data[name].shape
+        chunk_shape = resolve_chunks(policy[role]['chunks'], shape)
+        codec, options, measurements = select_codec(data[name], chunk_shape, goal,
+                                                    disk_bytes_per_s=disk_bytes_per_s)
+        policy[role] = dict(chunks=policy[role]['chunks'], **options)
+        selection['datasets'][role] = {'codec': codec, 'options': options, 'chunks': list(chunk_shape),
+                                       'measurements': measurements}
+    return policy, selection
@@ -0,0 +1,88 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+
+
+# ==========================================================================
+# ------------------------------- dF/F stage -------------------------------
+# ==========================================================================
+# dF/F = (F - F0) / F0 for all ROIs of a plane at once, with a sliding-window baseline F0:
+#   'percentile' : the baseline_percentile-th percentile of the window_frames frames around each
+#                  frame, evaluated every window_frames // 10 frames and linearly interpolated
+#   'maximin'    : Suite2p-style minimum then maximum filter of the Gaussian-smoothed traces
+# The (frames, rois) matrix is processed in time chunks extended on both sides by the frames their
+# baseline depends on, so every chunk computes the baseline of its own frames exactly. Chunks run
+# on a thread pool (the NumPy / SciPy kernels release the GIL) and memory stays at a few chunks.
+
+BASELINE_METHODS = ('percentile', 'maximin')
+
+
+def percentile_baseline(traces, window_frames, percentile, step=None, offset=0):
+    # (frames, rois) baseline; windows are mirrored at the ends of traces. Percentiles are evaluated
+    # on frames whose index + offset is a multiple of step, so chunks of one matrix share the grid.
+    # window_frames is not clamped to traces, which may be a chunk: compute_df_over_f clamps it to the
+    # whole recording so every chunk uses the same window
+    num_frames = len(traces)
+    step = max(1, step or window_frames // 10)
+    half = window_frames // 2
+    padded = np.pad(traces, ((half, window_frames - 1 - half), (0, 0)), mode='reflect')
+    centers = np.unique(np.concatenate([[0], np.arange(-offset % step, num_frames, step), [num_frames - 1]]))
+    # one window at a time, a (centers, window, rois) copy would not stay bounded
+    samples = np.stack([np.percentile(padded[center:center + window_frames], percentile, axis=0)
+                        for center in centers]).astype(traces.dtype)
+    if len(centers) == num_frames:
+        return samples
+    # linear interpolation between the evaluated frames, all ROIs at once
+    right = np.clip(np.searchsorted(centers, np.arange(num_frames), side='right'), 1, len(centers) - 1)
+    left = right - 1
+    fraction = ((np.arange(num_frames) - centers[left]) / (centers[right] - centers[left]))[:, None]
+    return (samples[left] * (1 - fraction) + samples[right] * fraction).astype(traces.dtype)
+
+
+def maximin_baseline(traces, window_frames, sigma_frames):
+    smoothed = ndimage.gaussian_filter1d(traces, sigma_frames, axis=0, mode='nearest')
+    smoothed = ndimage.minimum_filter1d(smoothed, window_frames, axis=0, mode='nearest')
+    return ndimage.maximum_filter1d(smoothed, window_frames, axis=0, mode='nearest')
+
+
+def chunk_baseline(traces, start, stop, margin, method, window_frames, percentile, sigma_frames):
+    # baseline of frames start:stop, computed on the chunk extended by margin frames on both sides
+    lo, hi = max(start - margin, 0), min(stop + margin, len(traces))
+    extended = np.asarray(traces[lo:hi], dtype=np.float32)
+    if method == 'percentile':
+        baseline = percentile_baseline(extended, window_frames, percentile, offset=lo)
+    else:
+        baseline = maximin_baseline(extended, window_frames, sigma_frames)
+    return baseline[start - lo:stop - lo]
+
+
+def compute_df_over_f(traces, window_frames, method='percentile', percentile=8., sigma_frames=None,
+                      chunk_frames=4096, workers=None, dtype=np.float32):
+    """(frames, rois) dF/F of traces, see the module comment; F0 <= 0 gives 0."""
+    if method not in BASELINE_METHODS:
+        raise ValueError(f'Unknown baseline method {method!r}, choose one of {BASELINE_METHODS}')
+    num_frames = len(traces)
+    # a percentile window longer than the recording is the whole recording
+    window_frames = max(min(int(window_frames), num_frames) if method == 'percentile' else int(window_frames), 1)
+    sigma_frames = sigma_frames or max(window_frames / 60, 1.)
+    # frames beyond a chunk that its baseline depends on: half a window plus the interpolation step of
+    # the percentile windows, or the Gaussian (4 sigma) plus two half-window filters for maximin
+    if method == 'percentile':
+        margin = window_frames // 2 + max(1, window_frames // 10) + 1
+    else:
+        margin = window_frames + int(np.ceil(4 * sigma_frames)) + 1
+    chunk_frames = max(chunk_frames, margin)
+    out = np.empty(np.shape(traces), dtype=dtype)
+
+    def run(start):
+        stop = min(start + chunk_frames, num_frames)
+        baseline = chunk_baseline(traces, start, stop, margin, method, window_frames, percentile, sigma_frames)
+        values = np.asarray(traces[start:stop], dtype=np.float32)
+        np.divide(values - baseline, baseline, out=out[start:stop], where=baseline > 0)
+        out[start:stop][baseline <= 0] = 0
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        list(executor.map(run, range(0, num_frames, chunk_frames)))
+    return out
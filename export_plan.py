@@ -0,0 +1,217 @@
+import copy
+import glob
+import json
+
+import h5py
+import numpy as np
+
+from export_stats import load_records
+from nwb_storage import dataset_options
+from nwb_zarr import shared_copy_bytes
+
+
+# ==========================================================================
+# ------------------------- Dry-run export planning ------------------------
+# ==========================================================================
+# export_to_nwb(plan=True) only reads scan metadata and returns, per dataset, its shape, on-disk
+# dtype, codec and predicted stored size, and for the session the predicted file size, peak memory
+# and write time. Predictions use calibration numbers:
+#   read_bytes_per_s       scan pages read from disk (streamed stacks, summary / motion / trace passes)
+#   write_bytes_per_s      stored bytes written to the NWB file
+#   compress_bytes_per_s   uncompressed bytes encoded per second, per codec family
+#   compression_ratio      uncompressed / stored bytes, per role and codec family ('*' for any role)
+#   base_memory_bytes      resident memory of the exporting process before any plane is prepared
+# calibrate() replaces the defaults with measured values: codec ratios and speeds from the codec
+# selection records of exported files, then disk write throughput from export stats (export_stats.py),
+# whose records carry the plan of their export.
+
+CODEC_FAMILIES = ('none', 'gzip', 'lzf', 'plugin')
+
+DEFAULT_CALIBRATION = {
+    'read_bytes_per_s': 300e6,
+    'write_bytes_per_s': 200e6,
+    'compress_bytes_per_s': {'none': None, 'gzip': 40e6, 'lzf': 250e6, 'plugin': 400e6},
+    'compression_ratio': {'*': {'none': 1., 'gzip': 1.2, 'lzf': 1.1, 'plugin': 1.2},
+                          'xy_translation': {'none': 1., 'gzip': 20., 'lzf': 5., 'plugin': 20.}},
+    'base_memory_bytes': 250e6,
+}
+
+# codec family assumed for datasets whose codec is only picked at export time (codec_goal)
+CODEC_GOAL_FAMILIES = {'size': 'gzip', 'write': 'lzf', 'read': 'lzf'}
+
+
+def codec_family(options):
+    compression = options.get('compression')
+    if compression is None:
+        return 'none'
+    if compression in ('gzip', 'lzf'):
+        return compression
+    return 'plugin'
+
+
+def selection_codec_family(codec_name):
+    # codec names of codec_select.candidate_codecs: 'none', 'lzf', 'gzip-4', 'zstd-3', 'blosc-lz4-5', ...
+    family = codec_name.split('-')[0]
+    return family if family in CODEC_FAMILIES else 'plugin'
+
+
+def compression_ratio(calibration, role, family):
+    ratios = calibration['compression_ratio']
+    return ratios.get(role, {}).get(family) or ratios['*'].get(family) or 1.
+
+
+def plan_dataset(shape, dtype, role, storage_policy, calibration, codec_goal=None):
+    shape = tuple(int(size) for size in shape)
+    raw_bytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+    options = dataset_options(storage_policy, role, shape) if role else {}
+    family = CODEC_GOAL_FAMILIES[codec_goal] if codec_goal and role else codec_family(options)
+    stored_bytes = int(raw_bytes / compression_ratio(calibration, role, family))
+    compress_speed = calibration['compress_bytes_per_s'].get(family)
+    return {'shape': shape,
+            'dtype': np.dtype(dtype).str,
+            'role': role,
+            'codec': family,
+            'chunks': options.get('chunks'),
+            'raw_bytes': raw_bytes,
+            'stored_bytes': stored_bytes,
+            'compress_seconds': raw_bytes / compress_speed if compress_speed else 0.,
+            'write_seconds': stored_bytes / calibration['write_bytes_per_s']}
+
+
+def plan_plane(plane_spec, storage_policy, calibration, codec_goal=None):
+    # plane_spec: {'datasets': {name: (shape, dtype, role, streamed)}, 'resident_bytes', 'transient_bytes',
+    #              'scan_read_bytes', 'streamed_read_bytes'}, see plane_plan_spec in the export script
+    datasets = {name: dict(plan_dataset(shape, dtype, role, storage_policy, calibration, codec_goal),
+                           streamed=streamed)
+                for name, (shape, dtype, role, streamed) in plane_spec['datasets'].items()}
+    return {'datasets': datasets,
+            'stored_bytes': sum(dataset['stored_bytes'] for dataset in datasets.values()),
+            'resident_bytes': plane_spec['resident_bytes'],
+            'transient_bytes': plane_spec['transient_bytes'],
+            # reads during preparation (summary, motion, trace passes) and while writing streamed stacks
+            'prepare_read_seconds': plane_spec['scan_read_bytes'] / calibration['read_bytes_per_s'],
+            'streamed_read_bytes': plane_spec['streamed_read_bytes'],
+            'write_seconds': sum(dataset['compress_seconds'] + dataset['write_seconds']
+                                 for dataset in datasets.values())
+                             + plane_spec['streamed_read_bytes'] / calibration['read_bytes_per_s']}
+
+
+def peak_memory(planes, calibration, sharded=False, checkpoint=False, plane_workers=None, copy_bytes=0):
+    # threads: every plane's arrays stay resident until the file is written, plus the transient memory of
+    # the planes prepared at the same time, or the copy_bytes the writer makes of them if more;
+    # checkpoints: one plane at a time; sharded: each worker process holds one plane and the main
+    # process holds none of the heavy data
+    base = calibration['base_memory_bytes']
+    if not planes:
+        return base
+    workers = min(plane_workers or len(planes), len(planes))
+    per_plane = sorted((plane['resident_bytes'] + plane['transient_bytes'] for plane in planes), reverse=True)
+    if checkpoint and not sharded:
+        return base + per_plane[0]
+    if sharded:
+        return base + sum(per_plane[:workers]) + workers * base
+    transient = sorted((plane['transient_bytes'] for plane in planes), reverse=True)
+    return base + sum(plane['resident_bytes'] for plane in planes) + max(sum(transient[:workers]), copy_bytes)
+
+
+def summarize_plan(session_key, output_fp, planes, calibration, sharded=False, checkpoint=False,
+                   plane_workers=None, codec_goal=None, backend='hdf5'):
+    plane_list = list(planes.values())
+    # the Zarr writer's workers may need copies of the in-memory datasets, see nwb_zarr.py
+    copy_bytes = shared_copy_bytes(dataset['raw_bytes'] for plane in plane_list
+                                   for dataset in plane['datasets'].values()
+                                   if dataset['role'] not in (None, 'pixel_mask') and not dataset['streamed']) \
+        if backend == 'zarr' else 0
+    stored_bytes = sum(plane['stored_bytes'] for plane in plane_list)
+    if sharded:
+        # the planes' data goes to the shards, written concurrently by the workers
+        workers = min(plane_workers or len(plane_list), len(plane_list)) or 1
+        write_seconds = sum(plane['write_seconds'] for plane in plane_list) / workers
+    else:
+        write_seconds = sum(plane['write_seconds'] for plane in plane_list)
+    return {'session_key': session_key,
+            'output_fp': str(output_fp),
+            'planes': planes,
+            'file_bytes': stored_bytes,
+            'peak_memory_bytes': int(peak_memory(plane_list, calibration, sharded=sharded, checkpoint=checkpoint,
+                                                 plane_workers=plane_workers, copy_bytes=copy_bytes)),
+            'prepare_read_seconds': sum(plane['prepare_read_seconds'] for plane in plane_list),
+            'write_seconds': write_seconds,
+            'sharded': sharded,
+            'codec_goal': codec_goal,
+            'calibration': calibration}
+
+
+def print_plan(plan):
+    print(f'\tPlan for {plan["output_fp"]}:')
+    print(f'\t{"plane":<7}{"dataset":<18}{"shape":<22}{"dtype":<8}{"codec":<8}{"stored MB":>11}{"write s":>9}')
+    for center_plane, plane in plan['planes'].items():
+        for name, dataset in plane['datasets'].items():
+            print(f'\t{center_plane:<7}{name:<18}{str(dataset["shape"]):<22}{dataset["dtype"]:<8}'
+                  f'{dataset["codec"]:<8}{dataset["stored_bytes"] / 1e6:>11.1f}'
+                  f'{dataset["compress_seconds"] + dataset["write_seconds"]:>9.2f}')
+    print(f'\tfile {plan["file_bytes"] / 1e6:.1f} MB, peak memory {plan["peak_memory_bytes"] / 1e6:.0f} MB, '
+          f'scan reads {plan["prepare_read_seconds"]:.1f}s, write {plan["write_seconds"]:.1f}s')
+
+
+# ----- Calibration -----
+
+def plan_record(plan):
+    # what calibrate() needs from the plan of an export, stored with its stats record
+    raw_bytes_by_codec = {}
+    for plane in plan['planes'].values():
+        for dataset in plane['datasets'].values():
+            raw_bytes_by_codec[dataset['codec']] = raw_bytes_by_codec.get(dataset['codec'], 0) + dataset['raw_bytes']
+    return {'stored_bytes': plan['file_bytes'],
+            'raw_bytes_by_codec': raw_bytes_by_codec,
+            'streamed_read_bytes': sum(plane['streamed_read_bytes'] for plane in plan['planes'].values()),
+            'sharded': plan['sharded'],
+            'codec_goal': plan['codec_goal']}
+
+
+def calibrate(stats_path=None, nwb_fps=(), calibration=None, **tags):
+    # DEFAULT_CALIBRATION (or calibration) updated with the measurements that are available
+    calibration = copy.deepcopy(calibration or DEFAULT_CALIBRATION)
+    ratios, speeds = {}, {}
+    for nwb_fp in (nwb_fp for pattern in nwb_fps for nwb_fp in glob.glob(str(pattern))):
+        for selection in read_codec_selections(nwb_fp):
+            for role, dataset in selection['datasets'].items():
+                for codec_name, measurement in dataset['measurements'].items():
+                    family = selection_codec_family(codec_name)
+                    ratios.setdefault(role, {}).setdefault(family, []).append(measurement['ratio'])
+                    if measurement['write_seconds'] > 0:
+                        speeds.setdefault(family, []).append(measurement['raw_bytes'] / measurement['write_seconds'])
+    for role, families in ratios.items():
+        calibration['compression_ratio'].setdefault(role, {}).update(
+            {family: float(np.median(values)) for family, values in families.items()})
+    for family, values in speeds.items():
+        if family != 'none':
+            calibration['compress_bytes_per_s'][family] = float(np.median(values))
+    if stats_path:
+        # disk throughput of past exports: their write stage time minus the encoding and scan reads their
+        # plan predicts, for the bytes they actually wrote. Sharded exports write outside the write stage
+        # and the codecs of codec_goal exports are only known once written, both are left out
+        written, seconds = 0, 0.
+        for record in load_records(stats_path, **tags):
+            planned = record.get('plan')
+            if not planned or planned['sharded'] or planned['codec_goal'] or 'write' not in record['stages']:
+                continue
+            stage = record['stages']['write']
+            encode_seconds = sum(raw_bytes / calibration['compress_bytes_per_s'][family]
+                                 for family, raw_bytes in planned['raw_bytes_by_codec'].items()
+                                 if calibration['compress_bytes_per_s'].get(family))
+            written += stage['bytes_written']
+            seconds += max(stage['seconds'] - encode_seconds
+                           - planned['streamed_read_bytes'] / calibration['read_bytes_per_s'], 0.)
+        if written > 0 and seconds > 0:
+            calibration['write_bytes_per_s'] = written / seconds
+    return calibration
+
+
+def read_codec_selections(nwb_fp):
+    # the scratch/codec_selection_<center_plane> records written with codec_goal
+    with h5py.File(nwb_fp, 'r') as f:
+        if 'scratch' not in f:
+            return []
+        return [json.loads(f['scratch'][name][()]) for name in f['scratch']
+                if name.startswith('codec_selection_')]
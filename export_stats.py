@@ -0,0 +1,169 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from dateutil.tz import tzlocal
+
+
+# ==========================================================================
+# ------------------ Per-stage timing and memory of exports ----------------
+# ==========================================================================
+# export_to_nwb wraps each of its stages in recorder.stage(name). A stage entered several times
+# (e.g. once per plane) accumulates wall and CPU time and bytes and keeps the largest peak. A stage
+# that raises is still timed and counted in its 'errors', and the session record is appended with
+# status 'failed' and the error.
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class PeakMemorySampler:
+    # polls the resident set size in a background thread, peak is relative to the RSS at entry
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start_rss = self.peak_rss = 0
+        self._stop = threading.Event()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = current_rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+    @property
+    def peak_delta(self):
+        return self.peak_rss - self.start_rss
+
+
+class ExportRecorder:
+
+    def __init__(self, session_key, tags=None):
+        self.session_key = session_key
+        # a copy, the tags of a batch are shared by all of its exports
+        self.tags = dict(tags or {})
+        # plan_record of the export (stats_plan=True), see export_plan.calibrate
+        self.plan = None
+        self.stages = {}
+        self.started = datetime.now(tzlocal()).isoformat()
+        self.status = 'ok'
+        self.error = None
+
+    @contextmanager
+    def stage(self, name, bytes_fn=None):
+        # bytes_fn is called after the stage and returns the bytes it wrote (e.g. the output file size)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        failed = True
+        memory = PeakMemorySampler()
+        try:
+            with memory:
+                yield
+            failed = False
+        finally:
+            stage = self.stages.setdefault(name, {'seconds': 0., 'cpu_seconds': 0., 'peak_memory_delta_bytes': 0,
+                                                  'bytes_written': 0, 'calls': 0, 'errors': 0})
+            stage['seconds'] += time.perf_counter() - wall_start
+            stage['cpu_seconds'] += time.process_time() - cpu_start
+            stage['peak_memory_delta_bytes'] = max(stage['peak_memory_delta_bytes'], memory.peak_delta)
+            stage['calls'] += 1
+            if failed:
+                stage['errors'] += 1
+            elif bytes_fn:
+                stage['bytes_written'] += bytes_fn()
+
+    @contextmanager
+    def session(self, stats_path=None):
+        # appends the record to stats_path when the export ends, also when it fails; exports that
+        # ran no stage (dry runs, files already up to date) leave no record
+        try:
+            yield self
+        except BaseException as e:
+            self.status, self.error = 'failed', f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            if stats_path and (self.stages or self.status == 'failed'):
+                append_record(stats_path, self.record())
+
+    def record(self):
+        return dict(self.tags,
+                    session_key=self.session_key,
+                    started=self.started,
+                    status=self.status,
+                    error=self.error,
+                    plan=self.plan,
+                    stages=self.stages,
+                    seconds=sum(stage['seconds'] for stage in self.stages.values()),
+                    bytes_written=sum(stage['bytes_written'] for stage in self.stages.values()))
+
+
+def append_record(stats_path, record):
+    # one JSON line per session, written with a single append so worker processes can share the file
+    line = (json.dumps(record, default=str) + '\n').encode()
+    fd = os.open(stats_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def load_records(stats_path, **tags):
+    # records whose tags match, e.g. load_records(path, batch_id=...)
+    records = []
+    if not os.path.exists(stats_path):
+        return records
+    with open(stats_path) as f:
+        for line in f:
+            record = json.loads(line)
+            if all(record.get(key) == value for key, value in tags.items()):
+                records.append(record)
+    return records
+
+
+def aggregate_records(records):
+    stages = {}
+    for record in records:
+        for name, stage in record['stages'].items():
+            total = stages.setdefault(name, {'seconds': 0., 'cpu_seconds': 0., 'bytes_written': 0,
+                                             'max_seconds': 0., 'max_peak_memory_delta_bytes': 0,
+                                             'slowest_session': None})
+            total['seconds'] += stage['seconds']
+            total['cpu_seconds'] += stage['cpu_seconds']
+            total['bytes_written'] += stage['bytes_written']
+            total['max_peak_memory_delta_bytes'] = max(total['max_peak_memory_delta_bytes'],
+                                                       stage['peak_memory_delta_bytes'])
+            if stage['seconds'] >= total['max_seconds']:
+                total['max_seconds'] = stage['seconds']
+                total['slowest_session'] = record['session_key']
+    for total in stages.values():
+        total['mean_seconds'] = total['seconds'] / len(records)
+    slowest = sorted(records, key=lambda record: record['seconds'], reverse=True)
+    return {'sessions': len(records),
+            'seconds': sum(record['seconds'] for record in records),
+            'bytes_written': sum(record['bytes_written'] for record in records),
+            'stages': stages,
+            'slowest_sessions': [(record['session_key'], record['seconds']) for record in slowest[:5]]}
+
+
+def print_aggregate(aggregate):
+    print(f'\t{"stage":<20}{"total s":>10}{"mean s":>10}{"max s":>10}{"max mem MB":>12}  slowest session')
+    for name, stage in aggregate['stages'].items():
+        print(f'\t{name:<20}{stage["seconds"]:>10.2f}{stage["mean_seconds"]:>10.2f}{stage["max_seconds"]:>10.2f}'
+              f'{stage["max_peak_memory_delta_bytes"] / 1e6:>12.1f}  {stage["slowest_session"]}')
@@ -0,0 +1,202 @@
+import abc
+import json
+import queue
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime
+
+
+# ==========================================================================
+# -------------------- Batched, prefetching metadata sources ---------------
+# ==========================================================================
+# export_to_nwb needs three things per session: the session row, the subject row and the plane
+# keys. A metadata source returns them for a whole batch of session keys at once:
+#
+#   {session_id(session_key): {'session': {...}, 'subject': {..., 'strain': ...}, 'plane_keys': [...]}}
+#
+# Subclass MetadataSource and implement fetch_batch for another backend (e.g. DataJoint, with
+# one restriction by the list of keys per table); SQLiteMetadataSource is the offline stand-in.
+
+SESSION_COLUMNS = ('session_name', 'recording_order', 'recording_name', 'animal_id', 'datasource_id',
+                   'animal_name', 'timestamp', 'combined', 'timeseries_name', 'equipment_type', 'username')
+SUBJECT_COLUMNS = ('animal_id', 'datasource_id', 'animal_species', 'animal_name', 'animal_sex', 'animal_dob',
+                   'color', 'animal_notes', 'strain')
+PLANE_COLUMNS = ('session_name', 'recording_order', 'recording_name', 'dataset_name', 'center_plane')
+# a session is identified by its animal and its name, session keys must hold all three
+SESSION_KEY_COLUMNS = ('animal_id', 'datasource_id', 'session_name')
+PLANE_TABLE_COLUMNS = ('animal_id', 'datasource_id') + PLANE_COLUMNS
+
+
+def session_id(session_key):
+    # session keys are DataJoint-style dicts, records are looked up by their canonical JSON
+    return json.dumps(session_key, sort_keys=True, default=str)
+
+
+class MetadataSource(abc.ABC):
+
+    @abc.abstractmethod
+    def fetch_batch(self, session_keys):
+        pass
+
+    def fetch(self, session_key):
+        return self.fetch_batch([session_key])[session_id(session_key)]
+
+    def fetch_all(self, session_keys, batch_size=64):
+        records = {}
+        for start in range(0, len(session_keys), batch_size):
+            records.update(self.fetch_batch(session_keys[start:start + batch_size]))
+        return records
+
+    def close(self):
+        pass
+
+
+class ConnectionPool:
+    # a fixed set of connections handed out one caller at a time, opened on first use
+    def __init__(self, connect, size=4):
+        self.connect = connect
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._opened = []
+
+    @contextmanager
+    def connection(self):
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            if len(self._opened) < self.size:
+                connection = self.connect()
+                self._opened.append(connection)
+            else:
+                connection = self._idle.get()
+        try:
+            yield connection
+        finally:
+            self._idle.put(connection)
+
+    def close(self):
+        for connection in self._opened:
+            connection.close()
+        self._opened = []
+        self._idle = queue.LifoQueue()
+
+
+class SQLiteMetadataSource(MetadataSource):
+    """Session, subject and plane tables in a SQLite file, three queries per batch."""
+
+    def __init__(self, db_path, pool_size=4):
+        self.db_path = db_path
+        self.pool = ConnectionPool(lambda: sqlite3.connect(db_path, check_same_thread=False), size=pool_size)
+
+    def create_tables(self):
+        with self.pool.connection() as connection, connection:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS session ({", ".join(SESSION_COLUMNS)}, '
+                               f'PRIMARY KEY ({", ".join(SESSION_KEY_COLUMNS)}))')
+            connection.execute(f'CREATE TABLE IF NOT EXISTS subject ({", ".join(SUBJECT_COLUMNS)}, '
+                               f'PRIMARY KEY (animal_id, datasource_id))')
+            # plane rows carry the animal of their session, plane keys alone do not tell sessions apart
+            connection.execute(f'CREATE TABLE IF NOT EXISTS plane ({", ".join(PLANE_TABLE_COLUMNS)}, '
+                               f'PRIMARY KEY ({", ".join(PLANE_TABLE_COLUMNS)}))')
+
+    def insert(self, table, rows):
+        columns = {'session': SESSION_COLUMNS, 'subject': SUBJECT_COLUMNS, 'plane': PLANE_TABLE_COLUMNS}[table]
+        values = [tuple(encode_value(row[column]) for column in columns) for row in rows]
+        with self.pool.connection() as connection, connection:
+            connection.executemany(f'INSERT OR REPLACE INTO {table} VALUES ({", ".join("?" * len(columns))})',
+                                   values)
+
+    def insert_records(self, records):
+        # records as returned by fetch_batch (or export_to_nwb's default_metadata)
+        records = list(records)
+        self.create_tables()
+        self.insert('session', [record['session'] for record in records])
+        self.insert('subject', [record['subject'] for record in records])
+        self.insert('plane', [dict(plane, animal_id=record['session']['animal_id'],
+                                   datasource_id=record['session']['datasource_id'])
+                              for record in records for plane in record['plane_keys']])
+
+    def fetch_batch(self, session_keys):
+        keys = sorted({session_key_values(session_key) for session_key in session_keys})
+        key_rows = f'({", ".join(SESSION_KEY_COLUMNS)}) IN (VALUES {", ".join(["(?, ?, ?)"] * len(keys))})'
+        key_values = [value for key in keys for value in key]
+        with self.pool.connection() as connection:
+            sessions = query_rows(connection, f'SELECT {", ".join(SESSION_COLUMNS)} FROM session '
+                                              f'WHERE {key_rows}', key_values, SESSION_COLUMNS)
+            subject_keys = sorted({(row['animal_id'], row['datasource_id']) for row in sessions})
+            subjects = query_rows(connection, f'SELECT {", ".join(SUBJECT_COLUMNS)} FROM subject '
+                                              f'WHERE (animal_id, datasource_id) IN '
+                                              f'(VALUES {", ".join(["(?, ?)"] * len(subject_keys))})',
+                                  [value for key in subject_keys for value in key], SUBJECT_COLUMNS) \
+                if subject_keys else []
+            planes = query_rows(connection, f'SELECT {", ".join(PLANE_TABLE_COLUMNS)} FROM plane '
+                                            f'WHERE {key_rows} ORDER BY center_plane', key_values,
+                                PLANE_TABLE_COLUMNS)
+
+        sessions = {session_key_values(row): decode_session(row) for row in sessions}
+        subjects = {(row['animal_id'], row['datasource_id']): decode_subject(row) for row in subjects}
+        plane_keys = {}
+        for row in planes:
+            plane_keys.setdefault(session_key_values(row), []).append({column: row[column] for column in PLANE_COLUMNS})
+        records = {}
+        for session_key in session_keys:
+            session = sessions.get(session_key_values(session_key))
+            if session is None:
+                raise KeyError(f'No session {session_key!r} in {self.db_path}')
+            records[session_id(session_key)] = {
+                'session': session,
+                'subject': subjects[(session['animal_id'], session['datasource_id'])],
+                'plane_keys': plane_keys.get(session_key_values(session_key), [])}
+        return records
+
+    def close(self):
+        self.pool.close()
+
+
+def session_key_values(session_key):
+    return tuple(session_key[column] for column in SESSION_KEY_COLUMNS)
+
+
+def encode_value(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+
+def query_rows(connection, sql, parameters, columns):
+    return [dict(zip(columns, row)) for row in connection.execute(sql, parameters)]
+
+
+def decode_session(row):
+    return dict(row, timestamp=datetime.fromisoformat(row['timestamp']))
+
+
+def decode_subject(row):
+    return dict(row, animal_dob=date.fromisoformat(row['animal_dob']) if row['animal_dob'] else None)
+
+
+class MetadataPrefetcher:
+    """Hands out the records of session_keys in order, fetching batch i + 1 while batch i is used."""
+
+    def __init__(self, source, session_keys, batch_size=32):
+        self.source = source
+        self.batches = [session_keys[start:start + batch_size] for start in range(0, len(session_keys), batch_size)]
+        self.batch_index = {session_id(session_key): i for i, batch in enumerate(self.batches)
+                            for session_key in batch}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = {}
+        self._submit(0)
+
+    def _submit(self, i):
+        if i < len(self.batches) and i not in self._futures:
+            self._futures[i] = self._executor.submit(self.source.fetch_batch, self.batches[i])
+
+    def get(self, session_key):
+        i = self.batch_index[session_id(session_key)]
+        self._submit(i)
+        self._submit(i + 1)
+        # batches before the current one are not needed anymore
+        for done in [j for j in self._futures if j < i]:
+            del self._futures[done]
+        return self._futures[i].result()[session_id(session_key)]
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,131 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from scipy import fft
+
+from scan_utils import read_frame_block
+
+
+# ==========================================================================
+# --------------------- Rigid motion (phase correlation) -------------------
+# ==========================================================================
+# Per-frame rigid shifts of a plane against a reference image, block_size frames per FFT batch:
+#   1. reference: mean of reference_frames frames spread over the recording, re-averaged once
+#      after aligning them to that first mean
+#   2. every block is tapered at the edges, transformed with one batched rfft2, whitened against
+#      the reference spectrum and smoothed by a Gaussian (phase correlation)
+#   3. the correlation peak within +-max_shift pixels gives the shift, refined to sub-pixel
+#      precision by a parabola through the peak and its neighbours along each axis
+# Blocks are spread over a process pool. Shifts are (x, y) in pixels: the frame is the reference
+# moved by (x, y), i.e. frame[y, x] ~ reference[y - shift_y, x - shift_x].
+
+def edge_taper(height, width, taper_px):
+    # weights rising from 0 to 1 over taper_px pixels at every edge, removes FFT wrap-around edges
+    def ramp(size):
+        distance = np.minimum(np.arange(size), np.arange(size)[::-1]) + 0.5
+        return np.clip(distance / max(taper_px, 1), 0, 1)
+    return np.outer(ramp(height), ramp(width)).astype(np.float32)
+
+
+def gaussian_filter_spectrum(height, width, sigma):
+    # rfft2 spectrum of a Gaussian blur of sigma pixels
+    fy = np.fft.fftfreq(height)[:, None]
+    fx = np.fft.rfftfreq(width)[None, :]
+    return np.exp(-2 * (np.pi * sigma) ** 2 * (fy ** 2 + fx ** 2)).astype(np.float32)
+
+
+def prepare_frames(frames, taper):
+    frames = np.asarray(frames, dtype=np.float32)
+    frames = frames - frames.mean(axis=(-2, -1), keepdims=True)
+    return frames * taper
+
+
+def reference_spectrum(reference, taper, smooth):
+    # conjugate whitened spectrum of the reference, with the smoothing folded in
+    spectrum = fft.rfft2(prepare_frames(reference, taper))
+    return np.conj(spectrum) / (np.abs(spectrum) + 1e-6) * smooth
+
+
+def parabola_offset(left, center, right):
+    # vertex of the parabola through three equally spaced samples, relative to the center one
+    denominator = left - 2 * center + right
+    return np.divide(0.5 * (left - right), denominator, out=np.zeros_like(center), where=denominator < 0)
+
+
+def phase_correlation_shifts(frames, reference_conj, taper, max_shift, subpixel=True):
+    # (frames, 2) float64 (x, y) shifts of a block of frames
+    frames = prepare_frames(frames, taper)
+    height, width = frames.shape[-2:]
+    spectrum = fft.rfft2(frames)
+    spectrum /= np.abs(spectrum) + 1e-6
+    spectrum *= reference_conj
+    correlation = fft.irfft2(spectrum, s=(height, width))
+    # correlations at offsets -max_shift..max_shift, wrapped around the origin
+    offsets = np.arange(-max_shift, max_shift + 1)
+    window = correlation[:, (offsets % height)[:, None], (offsets % width)[None, :]]
+    size = len(offsets)
+    peak = window.reshape(len(frames), -1).argmax(axis=1)
+    peak_y, peak_x = np.divmod(peak, size)
+    shifts = np.stack([offsets[peak_x], offsets[peak_y]], axis=1).astype(np.float64)
+    if subpixel:
+        frame_index = np.arange(len(frames))
+        center = window[frame_index, peak_y, peak_x]
+        # peaks on the window border keep their integer shift
+        inner_x = (peak_x > 0) & (peak_x < size - 1)
+        inner_y = (peak_y > 0) & (peak_y < size - 1)
+        x_left = window[frame_index, peak_y, np.clip(peak_x - 1, 0, size - 1)]
+        x_right = window[frame_index, peak_y, np.clip(peak_x + 1, 0, size - 1)]
+        y_left = window[frame_index, np.clip(peak_y - 1, 0, size - 1), peak_x]
+        y_right = window[frame_index, np.clip(peak_y + 1, 0, size - 1), peak_x]
+        shifts[:, 0] += np.where(inner_x, parabola_offset(x_left, center, x_right), 0)
+        shifts[:, 1] += np.where(inner_y, parabola_offset(y_left, center, y_right), 0)
+    return shifts
+
+
+def block_shifts(scan, field, reference_conj, taper, max_shift, subpixel, frame_provider, block):
+    # runs in a worker process: reads frames block[0]:block[1] and registers them
+    frames = (frame_provider or read_frame_block)(scan, field, *block)
+    return phase_correlation_shifts(frames, reference_conj, taper, max_shift, subpixel=subpixel)
+
+
+def build_reference(scan, field=0, reference_frames=200, frame_provider=None, taper=None, smooth=None,
+                    max_shift=None):
+    # mean of frames spread over the recording, then the mean of the same frames aligned to it
+    frame_provider = frame_provider or read_frame_block
+    num_samples = min(reference_frames, scan.num_frames)
+    starts = np.unique(np.linspace(0, scan.num_frames - 1, max(num_samples // 10, 1)).astype(int))
+    frames = np.concatenate([frame_provider(scan, field, start, min(start + 10, scan.num_frames))
+                             for start in starts]).astype(np.float32)
+    reference = frames.mean(axis=0)
+    if taper is None:
+        return reference
+    shifts = phase_correlation_shifts(frames, reference_spectrum(reference, taper, smooth), taper, max_shift,
+                                      subpixel=False).astype(int)
+    aligned = [np.roll(frame, (-y, -x), axis=(0, 1)) for frame, (x, y) in zip(frames, shifts)]
+    return np.mean(aligned, axis=0)
+
+
+def estimate_motion(scan, field=0, block_size=100, frame_provider=None, workers=None, reference=None,
+                    reference_frames=200, max_shift_fraction=0.1, smooth_sigma=1.15, subpixel=True):
+    """(num_frames, 2) rigid (x, y) shifts of every frame of a scan field, see the module comment.
+
+    frame_provider(scan, field, start, stop) and scan are sent to the worker processes, so the provider
+    must be a module-level function (or a picklable object such as scan_utils.PageFrameReader).
+    """
+    height, width = scan.field_heights[field], scan.field_widths[field]
+    max_shift = max(1, int(max_shift_fraction * min(height, width)))
+    taper = edge_taper(height, width, max_shift)
+    smooth = gaussian_filter_spectrum(height, width, smooth_sigma)
+    if reference is None:
+        reference = build_reference(scan, field, reference_frames, frame_provider, taper, smooth, max_shift)
+    reference_conj = reference_spectrum(reference, taper, smooth)
+
+    blocks = [(start, min(start + block_size, scan.num_frames)) for start in range(0, scan.num_frames, block_size)]
+    register = partial(block_shifts, scan, field, reference_conj, taper, max_shift, subpixel, frame_provider)
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        return np.concatenate([register(block) for block in blocks])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return np.concatenate(list(executor.map(register, blocks)))
@@ -1,6 +1,12 @@
 import os, sys
+import gc
+import hashlib
+import warnings
 import collections
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from dateutil.tz import tzlocal
 import pytz
 import re
@@ -8,24 +14,75 @@ import numpy as np
 import json
 import pandas as pd
 import pathlib
+import shutil
 import pynwb
+import hdmf.common
+from hdmf.container import AbstractContainer
+from hdmf.utils import get_data_shape
+from pynwb.core import NWBMixin
 from pynwb import NWBFile, NWBHDF5IO
 from pynwb import NWBFile, TimeSeries, NWBHDF5IO
-from pynwb.image import ImageSeries
+from pynwb.base import Images
+from pynwb.image import GrayscaleImage, ImageSeries
 from pynwb.ophys import TwoPhotonSeries, OpticalChannel, ImageSegmentation, \
     Fluorescence, CorrectedImageStack, MotionCorrection, RoiResponseSeries, DfOverF
-import scanreader
+from scan_utils import LazyScan, ScanFrameIterator, plane_field, raw_frame_provider
+from nwb_storage import cast_dataset, dataset_dtype, policy_chunks, wrap_column, wrap_dataset
+from batch_export import run_parallel_export
+from metadata_source import MetadataPrefetcher, session_id
+from codec_select import CODEC_ROLES, select_plane_codecs, with_default_chunks
+from summary_images import SUMMARY_IMAGES, compute_summary_images
+from motion_estimation import estimate_motion
+from trace_extraction import extract_traces
+from df_over_f import compute_df_over_f
+from export_stats import ExportRecorder, aggregate_records, load_records, print_aggregate
+from nwb_update import begin_update, completed_planes, end_update, mark_checkpoint, partial_path, \
+    plane_input_hash, publish_file, needs_repack, read_plane_hashes, remove_planes, repack_file, \
+    update_interrupted, write_plane_hashes
+from nwb_shards import defer_pixel_mask, link_plane_shard, linked_shards, open_plane_shard, remove_stale_shards, \
+    shard_path, write_plane_shard
+from nwb_zarr import ZARR_SUFFIX, release_shared_arrays, require_zarr, store_bytes, write_zarr, zarr_data_io
+from nwb_dedup import deduplicate_planes, link_duplicates, read_dedup_index
+from export_plan import DEFAULT_CALIBRATION, plan_plane, plan_record, print_plan, summarize_plan
+from roi_utils import PIXEL_MASK_DTYPE, add_timestamp_offsets, create_plane_segmentation_bulk, frame_times, \
+    pixel_mask_array, roi_centroids, roi_time_offsets, seconds_per_line
+
+# partial files (see nwb_update.partial_path) are NWB files that are renamed once complete
+warnings.filterwarnings('ignore', message=r"The file path provided: .*\.partial does not end in '\.nwb'")
 
 # ============================== SET CONSTANTS ==========================================
 zero_zero_time = datetime.strptime('00:00:00', '%H:%M:%S').time()  # no precise time available
 institution = 'DataJoint - testing CorrectedImageStack'
 
-single_tiff_file = scanreader.read_scan('./k53_20160530_RSM_125um_41mW_zoom2p2_00001_00001.tif')
-add_tiff_file = scanreader.read_scan('./k53_20160530_RSM_125um_41mW_zoom2p2_00001_00001.tif')
+single_tiff_file = LazyScan('./k53_20160530_RSM_125um_41mW_zoom2p2_00001_00001.tif')
+add_tiff_file = LazyScan('./k53_20160530_RSM_125um_41mW_zoom2p2_00001_00001.tif')
 tiff_files = [single_tiff_file, add_tiff_file]
 
-def get_nwb_subject(session_key):
-    subj_key = {'animal_id': 'abc123', 'datasource_id': 0}
+NWB_BACKENDS = ('hdf5', 'zarr')
+
+# modules whose code computes the planes' datasets, part of every plane's input hash
+PLANE_CODE_MODULES = (__name__, 'scan_utils', 'roi_utils', 'nwb_storage', 'codec_select', 'summary_images',
+                      'motion_estimation', 'trace_extraction', 'df_over_f')
+
+# shapes of the example's placeholder data (see prepare_plane_data and plane_plan_spec), placeholder
+# traces and shifts have one row per scan frame
+PLACEHOLDER_STACK_SHAPE = (256, 265, 1000)
+NUM_ROIS = 169
+MASK_PIXELS_PER_ROI = 313
+
+def default_metadata(session_key):
+    # stand-in for the session, subject and plane queries, see metadata_source.py for real sources
+    session = {'session_name': 'abc123d4fcbb',
+                'recording_order': 0,
+                'recording_name': 'rrrrd24',
+                'animal_id': 'abc123',
+                'datasource_id': 0,
+                'animal_name': '123',
+                'timestamp': datetime(2022, 3, 1, 5, 30, 10),
+                'combined': 'yes',
+                'timeseries_name': '123_20220301_ML-100_DJ01_3Openfiled',
+                'equipment_type': '2Pminiscope_A',
+                'username': 'testuser'}
     subj = {'animal_id': 'abc123',
             'datasource_id': 0,
             'animal_species': 'mouse',
@@ -33,8 +90,25 @@ def get_nwb_subject(session_key):
             'animal_sex': 'M',
             'animal_dob': datetime.date(datetime(2022, 3, 1)),
             'color': 'Unknown',
-            'animal_notes': 'Sample animal'}
-    strain = 'C +/- x GC+/-'
+            'animal_notes': 'Sample animal',
+            'strain': 'C +/- x GC+/-'}
+    plane_keys = [{'session_name': 'abc123d4fcbb',
+                    'recording_order': 0,
+                    'recording_name': 'rrrrd24',
+                    'dataset_name': 'dddd280d',
+                    'center_plane': 0},
+                    {'session_name': 'abc123d4fcbb',
+                    'recording_order': 0,
+                    'recording_name': 'rrrrd24',
+                    'dataset_name': 'dddd280d',
+                    'center_plane': 1}]
+    return {'session': session, 'subject': subj, 'plane_keys': plane_keys}
+
+
+def get_nwb_subject(session_key, subj=None):
+    subj = subj or default_metadata(session_key)['subject']
+    subj_key = {'animal_id': subj['animal_id'], 'datasource_id': subj['datasource_id']}
+    strain = subj['strain']
 
     return pynwb.file.Subject(
         subject_id=f'{subj_key["animal_id"]}-{subj_key["datasource_id"]}-{session_key}',
@@ -45,201 +119,858 @@ def get_nwb_subject(session_key):
         date_of_birth=datetime.combine(subj['animal_dob'], zero_zero_time) if subj['animal_dob'] else None)
 
 
-def export_to_nwb(session_key, output_dir='./', overwrite=True):
+def plane_seed(plane):
+    # a stable seed per plane key, e.g. for the placeholder data of a plane
+    return int(hashlib.sha1(json.dumps(plane, sort_keys=True, default=str).encode()).hexdigest()[:16], 16)
+
+
+def plane_segmentation(plane, num_rois=NUM_ROIS, pixels_per_roi=MASK_PIXELS_PER_ROI):
+    # stand-in for the plane's segmentation query: ROI ids and pixel masks, the same for every export
+    # of the plane so they can be part of its input hash (see plane_inputs); export_to_nwb takes any
+    # function of the plane returning these arrays as segmentation=
+    rng = np.random.default_rng(plane_seed(plane))
+    cell_ids = np.arange(1, num_rois + 1)
+    mask_offsets = np.arange(len(cell_ids) + 1) * pixels_per_roi
+    return {'cell_ids': cell_ids,
+            'mask_offsets': mask_offsets,
+            'xpix_corr': rng.integers(321, 340, mask_offsets[-1]),
+            'ypix_corr': rng.integers(268, 301, mask_offsets[-1]),
+            'lambda_corr': rng.uniform(low=0.001, high=0.02, size=(mask_offsets[-1],))}
+
+
+def plane_inputs(plane, tiff_file, segmentation=None):
+    # what a plane's datasets are computed from besides its scan frames and the export options:
+    # masks, ROI ids and the per-ROI timestamp offsets (timestamp-error table), hashed by content
+    inputs = (segmentation or plane_segmentation)(plane)
+    field = plane_field(plane, tiff_file)
+    inputs['timestamp_offsets'] = roi_time_offsets(
+        tiff_file, field, roi_centroids(inputs['ypix_corr'], inputs['lambda_corr'], inputs['mask_offsets']))
+    inputs['frame_timing'] = np.array([tiff_file.fps, seconds_per_line(tiff_file, field), tiff_file.num_frames,
+                                       tiff_file.num_scanning_depths])
+    return inputs
+
+
+def prepare_plane_data(plane, tiff_file, stream_corrected=False, corrected_block_size=100,
+                       corrected_frame_provider=None, storage_policy=None, dtype_policy=None, embed_raw=False,
+                       codec_goal=None, summary_images=False, motion_estimation=False, motion_workers=None,
+                       extract_fluorescence=False, neuropil_coefficient=0.7, extraction_workers=None,
+                       df_over_f=None, baseline_window=60., baseline_percentile=8., dff_workers=None,
+                       segmentation=None):
+    # everything here only depends on its own plane, so planes can be prepared concurrently
+    data = {'num_planes': tiff_file.num_scanning_depths,
+            'framerate': tiff_file.fps}
+    if codec_goal:
+        # codecs are chosen per chunk, so every candidate dataset is chunked
+        storage_policy = with_default_chunks(storage_policy, CODEC_ROLES.values())
+
+    # ==========================================================================
+    # ------------------------- Raw frames (embedded) --------------------------
+    # ==========================================================================
+
+    if embed_raw:
+        # the plane's tiff pages are read one block of frames at a time while the file is written
+        field = plane_field(plane, tiff_file)
+        raw_shape = (tiff_file.num_frames, tiff_file.field_heights[field], tiff_file.field_widths[field])
+        data['raw'] = ScanFrameIterator(tiff_file,
+                                        field=field,
+                                        block_size=corrected_block_size,
+                                        frame_provider=raw_frame_provider(tiff_file, field),
+                                        chunk_shape=policy_chunks(storage_policy, 'raw', raw_shape))
+
+    # ==========================================================================
+    # ------------------------- Summary projections ----------------------------
+    # ==========================================================================
+
+    if summary_images:
+        # mean, max, std and local correlation images from a single pass over the plane's frames
+        field = plane_field(plane, tiff_file)
+        data['summary_images'] = compute_summary_images(
+            tiff_file, field=field, block_size=corrected_block_size,
+            frame_provider=corrected_frame_provider or raw_frame_provider(tiff_file, field))
+
+    # ==========================================================================
+    # --------------------- MotionCorrection information -----------------------
+    # ==========================================================================
+
+    if summary_images == 'only':
+        # the 'corrected' series holds the average projection its format describes, as one frame
+        data['corrected'] = cast_dataset(data['summary_images']['mean'][np.newaxis], 'corrected', dtype_policy)
+    elif stream_corrected:
+        # frames are read block by block while NWBHDF5IO.write runs, never the whole stack at once
+        field = plane_field(plane, tiff_file)
+        stack_shape = (tiff_file.num_frames, tiff_file.field_heights[field], tiff_file.field_widths[field])
+        data['corrected'] = ScanFrameIterator(tiff_file,
+                                              field=field,
+                                              block_size=corrected_block_size,
+                                              frame_provider=corrected_frame_provider,
+                                              dtype=dataset_dtype(dtype_policy, 'corrected') if dtype_policy else None,
+                                              chunk_shape=policy_chunks(storage_policy, 'corrected', stack_shape))
+    else:
+        data['corrected'] = np.ones(PLACEHOLDER_STACK_SHAPE, dtype=dataset_dtype(dtype_policy, 'corrected'))
+    if motion_estimation:
+        # rigid shifts of every raw frame against the plane's reference image, see motion_estimation.py
+        field = plane_field(plane, tiff_file)
+        shifts = estimate_motion(tiff_file, field=field, block_size=corrected_block_size,
+                                 frame_provider=raw_frame_provider(tiff_file, field), workers=motion_workers,
+                                 subpixel=not np.issubdtype(dataset_dtype(dtype_policy, 'xy_translation'), np.integer))
+        data['xy_translation'] = cast_dataset(shifts, 'xy_translation', dtype_policy)
+    else:
+        data['xy_translation'] = np.ones((tiff_file.num_frames, 2),
+                                         dtype=dataset_dtype(dtype_policy, 'xy_translation'))
+    # x and y shifts are column views into the (frames, 2) array that is written as is
+    data['x_mocor'] = data['xy_translation'][:, 0]
+    data['y_mocor'] = data['xy_translation'][:, 1]
+
+    # ==========================================================================
+    # -------------- ROIs (Image masks, Pixel masks) information ---------------
+    # ==========================================================================
+
+    # pixel masks of all ROIs concatenated, ROI i owns pixels mask_offsets[i]:mask_offsets[i + 1]
+    data.update((segmentation or plane_segmentation)(plane))
+    mask_offsets = data['mask_offsets']
+    data['pixel_mask'] = pixel_mask_array(data['xpix_corr'], data['ypix_corr'], data['lambda_corr'])
+
+    # ==========================================================================
+    # ----------------------- Flourescence information -------------------------
+    # ==========================================================================
+
+    trace_dtype = dataset_dtype(dtype_policy, 'roi_response')
+    if extract_fluorescence:
+        # all ROIs at once, one sparse product per block of (corrected) frames, see trace_extraction.py
+        field = plane_field(plane, tiff_file)
+        raw_fluo_traces, fluo_traces = extract_traces(
+            tiff_file, data['pixel_mask'], mask_offsets, field=field, block_size=corrected_block_size,
+            frame_provider=corrected_frame_provider or raw_frame_provider(tiff_file, field),
+            workers=extraction_workers, neuropil_coefficient=neuropil_coefficient,
+            dtype=np.result_type(np.float32, trace_dtype))
+        if fluo_traces is not None:
+            data['fluo_traces'] = cast_dataset(fluo_traces, 'roi_response', dtype_policy)
+    else:
+        # placeholder traces seeded per plane, so forked (sharded) workers do not share a random stream
+        rng = np.random.default_rng((plane_seed(plane), plane['center_plane']))
+        raw_fluo_traces = rng.random((tiff_file.num_frames, len(data['cell_ids'])),
+                                     dtype=np.result_type(np.float32, trace_dtype))
+
+    # one shared frame-time vector for the plane, each ROI is sampled timestamp_offset seconds later
+    field = plane_field(plane, tiff_file)
+    data['timestamps'] = frame_times(tiff_file, field, len(raw_fluo_traces))
+    data['timestamp_offsets'] = roi_time_offsets(tiff_file, field,
+                                                 roi_centroids(data['ypix_corr'], data['lambda_corr'], mask_offsets))
+    # (frames, rois) as NWB expects, cast in place of a copy when the dtype already matches
+    data['raw_fluo_traces'] = cast_dataset(raw_fluo_traces, 'roi_response', dtype_policy)
+
+    if df_over_f:
+        # sliding-window baseline of all ROIs at once, from the neuropil corrected traces when there are any
+        data['dff_traces'] = cast_dataset(
+            compute_df_over_f(data.get('fluo_traces', data['raw_fluo_traces']),
+                              window_frames=round(baseline_window * tiff_file.fps), method=df_over_f,
+                              percentile=baseline_percentile, workers=dff_workers,
+                              dtype=np.result_type(np.float32, trace_dtype)),
+            'roi_response', dtype_policy)
+
+    if codec_goal:
+        # the plane is written with its own storage policy, see codec_select.py
+        data['storage_policy'], data['codec_selection'] = select_plane_codecs(data, storage_policy, codec_goal)
+    return data
+
+
+def plane_plan_spec(plane, tiff_file, stream_corrected=False, corrected_block_size=100, dtype_policy=None,
+                    embed_raw=False, summary_images=False, motion_estimation=False, motion_workers=None,
+                    extract_fluorescence=False, neuropil_coefficient=0.7, extraction_workers=None, df_over_f=None,
+                    dff_workers=None, segmentation=None, **prepare_kwargs):
+    # what prepare_plane_data would build for the plane, from scan metadata and its segmentation only (see
+    # export_plan.py): {name: (shape, dtype, role, streamed)}, the bytes held until the write, the largest
+    # temporary buffers and the scan bytes read before and during the write
+    rois = (segmentation or plane_segmentation)(plane)
+    num_rois, mask_pixels = len(rois['cell_ids']), int(rois['mask_offsets'][-1])
+    field = plane_field(plane, tiff_file)
+    num_frames, height, width = tiff_file.num_frames, tiff_file.field_heights[field], tiff_file.field_widths[field]
+    frame_dtype = np.dtype(getattr(tiff_file, 'page_dtype', None) or np.int16)
+    frame_pixels = height * width
+    block_frames = min(corrected_block_size, num_frames)
+    # traces, extracted or placeholders, have one row per scan frame of the plane
+    trace_frames = num_frames
+    trace_dtype = dataset_dtype(dtype_policy, 'roi_response')
+    cpus = os.cpu_count()
+
+    datasets = {}
+    if embed_raw:
+        datasets['raw'] = ((num_frames, height, width), frame_dtype, 'raw', True)
+    if summary_images == 'only':
+        datasets['corrected'] = ((1, height, width), dataset_dtype(dtype_policy, 'corrected'), 'corrected', False)
+    elif stream_corrected:
+        datasets['corrected'] = ((num_frames, height, width),
+                                 dataset_dtype(dtype_policy, 'corrected') if dtype_policy else frame_dtype,
+                                 'corrected', True)
+    else:
+        datasets['corrected'] = (PLACEHOLDER_STACK_SHAPE, dataset_dtype(dtype_policy, 'corrected'), 'corrected', False)
+    if summary_images:
+        datasets['summary_images'] = ((len(SUMMARY_IMAGES), height, width), np.float32, None, False)
+    datasets['xy_translation'] = ((num_frames, 2),
+                                  dataset_dtype(dtype_policy, 'xy_translation'), 'xy_translation', False)
+    datasets['pixel_mask'] = ((mask_pixels,), PIXEL_MASK_DTYPE, 'pixel_mask', False)
+    datasets['raw_fluo_traces'] = ((trace_frames, num_rois), trace_dtype, 'roi_response', False)
+    if extract_fluorescence and neuropil_coefficient is not None:
+        datasets['fluo_traces'] = ((trace_frames, num_rois), trace_dtype, 'roi_response', False)
+    if df_over_f:
+        datasets['dff_traces'] = ((trace_frames, num_rois), trace_dtype, 'roi_response', False)
+    datasets['timestamps'] = ((trace_frames,), np.float64, None, False)
+
+    def nbytes(shape, dtype):
+        return int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+
+    # x, y and weight arrays of the masks are kept next to the pixel_mask records
+    resident = sum(nbytes(shape, dtype) for shape, dtype, _, streamed in datasets.values() if not streamed) \
+        + 3 * 8 * mask_pixels
+    transient = [2 * block_frames * frame_pixels * 8]
+    if summary_images:
+        transient.append(block_frames * frame_pixels * 8)
+    if motion_estimation:
+        # float32 frames and their complex64 spectrum per worker
+        transient.append((motion_workers or cpus) * block_frames * frame_pixels * 12)
+    if extract_fluorescence:
+        rows = num_rois * (1 if neuropil_coefficient is None else 2)
+        transient.append(trace_frames * rows * 4 + (extraction_workers or cpus) * block_frames * frame_pixels * 4)
+    if df_over_f:
+        transient.append(trace_frames * num_rois * 4 + (dff_workers or cpus) * 3 * 2 * 4096 * num_rois * 4)
+    frame_bytes = frame_pixels * frame_dtype.itemsize
+    passes = bool(summary_images) + bool(motion_estimation) + bool(extract_fluorescence)
+    streamed = sum(streamed for _, _, _, streamed in datasets.values())
+    return {'datasets': datasets,
+            'resident_bytes': resident,
+            'transient_bytes': max(transient),
+            'scan_read_bytes': passes * num_frames * frame_bytes,
+            'streamed_read_bytes': streamed * num_frames * frame_bytes}
+
+
+def plan_planes(plane_scans, storage_policy=None, codec_goal=None, calibration=None, **prepare_kwargs):
+    return {plane['center_plane']: plan_plane(plane_plan_spec(plane, tiff_file, **prepare_kwargs), storage_policy,
+                                              calibration, codec_goal=codec_goal)
+            for plane, tiff_file in plane_scans}
+
+
+def export_plane_shard(plane, tiff_file, shard_fp, **prepare_kwargs):
+    # runs in a worker process: the heavy arrays go straight to the plane's shard file and only the
+    # small per-plane metadata is sent back
+    data = prepare_plane_data(plane, tiff_file, **prepare_kwargs)
+    write_plane_shard(shard_fp, data, storage_policy=data.get('storage_policy', prepare_kwargs.get('storage_policy')),
+                      dtype_policy=prepare_kwargs.get('dtype_policy'))
+    for name in ('raw', 'corrected', 'xy_translation', 'x_mocor', 'y_mocor', 'xpix_corr', 'ypix_corr',
+                 'lambda_corr', 'pixel_mask', 'raw_fluo_traces', 'fluo_traces', 'dff_traces'):
+        data.pop(name, None)
+    return data
+
+
+@contextmanager
+def shared_type_maps():
+    # pynwb and hdmf deep-copy their whole TypeMap for every field set on a container, only to look
+    # up termset configs (~9 ms each, most of the container assembly); within an export one copy of
+    # each, taken when it starts, serves all containers
+    type_maps = {NWBMixin: pynwb.get_type_map(), AbstractContainer: hdmf.common.get_type_map()}
+    getters = {cls: cls.__dict__['_get_type_map'] for cls in type_maps}
+    try:
+        for cls, type_map in type_maps.items():
+            cls._get_type_map = lambda self, type_map=type_map: type_map
+        yield
+    finally:
+        for cls, getter in getters.items():
+            cls._get_type_map = getter
+
+
+def export_to_nwb(session_key, output_dir='./', overwrite=True,
+                  stream_corrected=False, corrected_block_size=100, corrected_frame_provider=None,
+                  storage_policy=None, dtype_policy=None, plane_workers=None, update=False,
+                  repack_threshold=0.5, sharded=False, embed_raw=False, checkpoint=False, codec_goal=None,
+                  summary_images=False, motion_estimation=False, motion_workers=None, extract_fluorescence=False,
+                  neuropil_coefficient=0.7,
+                  extraction_workers=None, df_over_f=None, baseline_window=60., baseline_percentile=8.,
+                  dff_workers=None, dedup=False, backend='hdf5', write_workers=None, metadata=None, scans=None,
+                  segmentation=None, stats_path=None, stats_tags=None, stats_plan=False, plan=False,
+                  calibration=None):
 
     print(f'Exporting to NWB 2.0 for session: {session_key}...')
+    # wall/CPU time, peak memory and bytes of every stage, appended to stats_path as one JSON line
+    recorder = ExportRecorder(session_key, tags=stats_tags)
     # ===============================================================================
     # ============================== META INFORMATION ===============================
     # ===============================================================================
 
-    session = {'session_name': 'abc123d4fcbb',
-                'recording_order': 0,
-                'recording_name': 'rrrrd24',
-                'animal_id': 'abc123',
-                'datasource_id': 0,
-                'animal_name': '123',
-                'timestamp': datetime(2022, 3, 1, 5, 30, 10),
-                'combined': 'yes',
-                'timeseries_name': '123_20220301_ML-100_DJ01_3Openfiled',
-                'equipment_type': '2Pminiscope_A',
-                'username': 'testuser'}
+    # metadata: the session's record from a metadata source (write_nwb_files fetches them in batches)
+    metadata = metadata or default_metadata(session_key)
+    session = metadata['session']
     file_name = '_'.join(
         [session['session_name'],
          session['timestamp'].strftime('%Y-%m-%d'),
          str(session['timeseries_name'])])
-    nwbfile = NWBFile(
-            identifier=file_name,
-            related_publications='',
-            experiment_description='',
-            session_description='Imaging session',
-            session_start_time=datetime.combine(session['timestamp'], zero_zero_time),
-            file_create_date=datetime.now(tzlocal()),
-            experimenter='Test',
-            institution=institution,
-            keywords=['Two-photon imaging'])
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
 
-    # ==========================================================================
-    # ----- Create a Device, create an OpticalChannel and an ImagingPlane ------
-    # ==========================================================================
-    system_names = np.array(['System v1.0'])
-    scope_names = np.array(['Scope 1'])
-    device_name = ["{}_{}".format(system_name_, scope_name_) for system_name_, scope_name_ in zip(system_names,scope_names)][0]
-    device = nwbfile.create_device(name=device_name,
-                                   description="",
-                                   manufacturer=""
-                                   )
-    nwbfile.subject = get_nwb_subject(session_key)
-    optical_channel = OpticalChannel(name="OpticalChannel",
-                                     description="an optical channel",
-                                     emission_lambda=500.
-                                     )
+    if backend not in NWB_BACKENDS:
+        raise ValueError(f'Unknown backend {backend!r}, choose one of {NWB_BACKENDS}')
+    if backend == 'zarr':
+        require_zarr()
+        if update or checkpoint or sharded or dedup:
+            raise ValueError("backend='zarr' writes whole stores, update, checkpoint, sharded and dedup "
+                             "need the HDF5 backend")
+    save_file_name = ''.join([file_name, ZARR_SUFFIX if backend == 'zarr' else '.nwb'])
+    output_fp = (output_dir / save_file_name).absolute()
+    # a file left by an interrupted in-place update is exported again
+    interrupted = backend == 'hdf5' and output_fp.exists() and update_interrupted(output_fp)
+    if not overwrite and not update and output_fp.exists() and not interrupted and not plan:
+        print('\tDone.')
+        return None
 
-    plane_keys = [{'session_name': 'abc123d4fcbb',
-                    'recording_order': 0,
-                    'recording_name': 'rrrrd24',
-                    'dataset_name': 'dddd280d',
-                    'center_plane': 0},
-                    {'session_name': 'abc123d4fcbb',
-                    'recording_order': 0,
-                    'recording_name': 'rrrrd24',
-                    'dataset_name': 'dddd280d',
-                    'center_plane': 1}]
+    plane_keys = metadata['plane_keys']
+    # scans: one scan per plane key, e.g. synthetic ones (benchmark_export.py); the example's tiffs by default
+    plane_scans = list(zip(plane_keys, scans or tiff_files))
+    if dedup and sharded:
+        raise ValueError('dedup links datasets within the NWB file or a shared store, it cannot be combined '
+                         'with sharded=True')
+    # dedup=True links duplicates within the file, a path (relative to output_dir) names a shared store
+    dedup_store_fp = (output_dir / dedup).absolute() if isinstance(dedup, (str, pathlib.Path)) else None
 
-    ophys_module = nwbfile.create_processing_module(name='ophys',
-                                                    description='optical physiology processed data'
-                                                    )
-    img_seg = ImageSegmentation()
-    corrected_image_stacks = []
-    roi_resp_series = []
-    for plane, tiff_file in zip(plane_keys,tiff_files):
-        print(plane)
-        num_planes = tiff_file.num_scanning_depths
-        framerate = tiff_file.fps
-        imaging_plane = nwbfile.create_imaging_plane(name="ImagingPlane"+ '_' + str(plane['center_plane']),
-                                                    optical_channel=optical_channel,
-                                                    imaging_rate=framerate,
-                                                    description="",
-                                                    device=device,
-                                                    excitation_lambda=600.,
-                                                    indicator="GFP",
-                                                    location="",
-                                                    grid_spacing=(),
-                                                    grid_spacing_unit="",
-                                                    origin_coords=(),
-                                                    origin_coords_unit=""
-                                                    )
+    # the stats record is appended to stats_path when the export ends, also when it fails
+    # containers of the session share one TypeMap, see shared_type_maps
+    with recorder.session(stats_path), shared_type_maps():
+        # ==========================================================================
+        # ------------------------ Incremental update ------------------------------
+        # ==========================================================================
+        # only planes whose inputs changed since the last export are rebuilt and rewritten
+        export_options = {'stream_corrected': stream_corrected,
+                          'corrected_frame_provider': corrected_frame_provider,
+                          'storage_policy': storage_policy,
+                          'dtype_policy': dtype_policy,
+                          'sharded': sharded,
+                          'embed_raw': embed_raw,
+                          'codec_goal': codec_goal,
+                          'summary_images': summary_images,
+                          'motion_estimation': motion_estimation,
+                          'extract_fluorescence': extract_fluorescence,
+                          'neuropil_coefficient': neuropil_coefficient,
+                          'df_over_f': df_over_f,
+                          'baseline_window': baseline_window,
+                          'baseline_percentile': baseline_percentile,
+                          'dedup': str(dedup) if dedup_store_fp else dedup}
+        plane_hashes = {plane['center_plane']: plane_input_hash(plane, tiff_file, export_options,
+                                                                inputs=plane_inputs(plane, tiff_file,
+                                                                                    segmentation),
+                                                                code_modules=PLANE_CODE_MODULES)
+                        for plane, tiff_file in plane_scans}
+        plane_kwargs = dict(stream_corrected=stream_corrected,
+                            corrected_block_size=corrected_block_size,
+                            corrected_frame_provider=corrected_frame_provider,
+                            storage_policy=storage_policy,
+                            dtype_policy=dtype_policy,
+                            embed_raw=embed_raw,
+                            codec_goal=codec_goal,
+                            summary_images=summary_images,
+                            motion_estimation=motion_estimation,
+                            motion_workers=motion_workers,
+                            extract_fluorescence=extract_fluorescence,
+                            neuropil_coefficient=neuropil_coefficient,
+                            extraction_workers=extraction_workers,
+                            df_over_f=df_over_f,
+                            baseline_window=baseline_window,
+                            baseline_percentile=baseline_percentile,
+                            dff_workers=dff_workers,
+                            segmentation=segmentation,
+                            dedup=dedup,
+                            dedup_store_fp=dedup_store_fp,
+                            backend=backend,
+                            plane_workers=plane_workers,
+                            shard_output_fp=output_fp if sharded else None,
+                            recorder=recorder)
+        # ==========================================================================
+        # ------------------------------ Dry run -----------------------------------
+        # ==========================================================================
+        # plan=True only reads scan metadata and returns the predicted sizes, memory and write time;
+        # stats_plan=True plans the export too, for export_plan.calibrate (see below)
+        if plan or (stats_path and stats_plan):
+            planned_scans = plane_scans
+            if update and output_fp.exists() and not interrupted:
+                stored_hashes = read_plane_hashes(output_fp)
+                planned_scans = [(plane, tiff_file) for plane, tiff_file in plane_scans
+                                 if stored_hashes.get(plane['center_plane']) != plane_hashes[plane['center_plane']]]
+            calibration = calibration or DEFAULT_CALIBRATION
+            export_plan = summarize_plan(session_key, output_fp,
+                                         plan_planes(planned_scans, calibration=calibration, **plane_kwargs),
+                                         calibration, sharded=sharded, checkpoint=checkpoint,
+                                         plane_workers=plane_workers, codec_goal=codec_goal, backend=backend)
+            if plan:
+                print_plan(export_plan)
+                return export_plan
+            # the stats record carries the plan, export_plan.calibrate compares it with what happened
+            recorder.plan = plan_record(export_plan)
+
+        if update and interrupted:
+            print(f'\tAn earlier update of {save_file_name} did not finish, exporting it again')
+        elif update and output_fp.exists():
+            stored_hashes = read_plane_hashes(output_fp)
+            plane_scans = [(plane, tiff_file) for plane, tiff_file in plane_scans
+                           if stored_hashes.get(plane['center_plane']) != plane_hashes[plane['center_plane']]]
+            if not plane_scans:
+                print(f'\tUp to date: {save_file_name}')
+                print('\tDone.')
+                return None
+            center_planes = [plane['center_plane'] for plane, _ in plane_scans]
+            if sharded:
+                # the NWB file only holds metadata and links: the update goes to a copy of it and to new
+                # shards, and renaming the copy into place switches to them at once
+                update_fp = partial_path(output_fp)
+                try:
+                    with recorder.stage('copy', bytes_fn=lambda: update_fp.stat().st_size):
+                        shutil.copyfile(output_fp, update_fp)
+                    remove_planes(update_fp, center_planes)
+                    nwbfile = update_nwb_planes(update_fp, plane_scans, plane_hashes, **plane_kwargs)
+                    if needs_repack(update_fp, repack_threshold):
+                        with recorder.stage('repack', bytes_fn=lambda: update_fp.stat().st_size):
+                            repack_file(update_fp)
+                except BaseException:
+                    update_fp.unlink(missing_ok=True)
+                    raise
+                publish_file(update_fp, output_fp, sync_fps=linked_shards(update_fp))
+                remove_stale_shards(output_fp)
+            else:
+                # a copy would cost the whole file, the update is applied in place and the file is marked
+                # until it is done (see nwb_update.py)
+                begin_update(output_fp)
+                remove_planes(output_fp, center_planes)
+                nwbfile = update_nwb_planes(output_fp, plane_scans, plane_hashes, **plane_kwargs)
+                end_update(output_fp)
+                # the removed planes keep their space until the file is rewritten, which only pays off
+                # once they take a good share of it
+                if needs_repack(output_fp, repack_threshold):
+                    with recorder.stage('repack', bytes_fn=lambda: output_fp.stat().st_size):
+                        repack_file(output_fp)
+            print('\tDone.')
+            return nwbfile
 
         # ==========================================================================
-        # ---------------------------- Insert data file ----------------------------
+        # ------------------- Checkpoints and atomic publication -------------------
         # ==========================================================================
+        # the file is written as <file>.partial and only renamed to output_fp once complete; with
+        # checkpoint=True, planes are appended one at a time and a restart keeps the finished ones
+        partial_fp = partial_path(output_fp)
+        finished_planes = completed_planes(partial_fp, plane_hashes) if checkpoint and partial_fp.exists() else None
+        if finished_planes is not None:
+            print(f'\tResuming {partial_fp.name}: {len(finished_planes)} plane(s) already written')
+            nwbfile = None
+        else:
+            with recorder.stage('metadata'):
+                nwbfile = NWBFile(
+                        identifier=file_name,
+                        related_publications='',
+                        experiment_description='',
+                        session_description='Imaging session',
+                        session_start_time=datetime.combine(session['timestamp'], zero_zero_time),
+                        file_create_date=datetime.now(tzlocal()),
+                        experimenter='Test',
+                        institution=institution,
+                        keywords=['Two-photon imaging'])
 
-        file_path = np.array(['./k53_20160530_RSM_125um_41mW_zoom2p2_00001_00001.tif'])
-        image_series = TwoPhotonSeries(name='TwoPhotonSeries2'+'_'+str(plane['center_plane']),
-                                        dimension=[100, 100],
-                                        external_file=file_path,
-                                        imaging_plane=imaging_plane,
-                                        starting_frame=[0],
-                                        format='external',
-                                        starting_time=0.0,
-                                        rate=1.0
-                                        )
-        nwbfile.add_acquisition(image_series)
+                # ==========================================================================
+                # ----- Create a Device, create an OpticalChannel and an ImagingPlane ------
+                # ==========================================================================
+                system_names = np.array(['System v1.0'])
+                scope_names = np.array(['Scope 1'])
+                device_name = ["{}_{}".format(system_name_, scope_name_) for system_name_, scope_name_ in zip(system_names,scope_names)][0]
+                device = nwbfile.create_device(name=device_name,
+                                               description="",
+                                               manufacturer=""
+                                               )
+                nwbfile.subject = get_nwb_subject(session_key, metadata['subject'])
+
+                ophys_module = nwbfile.create_processing_module(name='ophys',
+                                                                description='optical physiology processed data'
+                                                                )
+                img_seg = ImageSegmentation()
+                motion_correction = MotionCorrection()
+                fl = Fluorescence()
+                ophys_module.add(motion_correction)
+                ophys_module.add(img_seg)
+                ophys_module.add(fl)
+
+            # without checkpoints all planes go into the single write below, with them the file is
+            # written without planes first; arrays handed to the Zarr writer's workers are released once
+            # the store is written, and also when assembling or writing it fails
+            plane_data = []
+            shared_arrays = []
+            try:
+                if not checkpoint:
+                    plane_data = add_planes(nwbfile, plane_scans, device, motion_correction, img_seg, fl,
+                                            shared_arrays=shared_arrays, **plane_kwargs)
+                finished_planes = set()
+
+                # ------------------------ Write to .nwb -------------------
+                with recorder.stage('write', bytes_fn=lambda: store_bytes(partial_fp)):
+                    if backend == 'zarr':
+                        # chunks of the large datasets are written by write_workers processes, see nwb_zarr.py
+                        write_zarr(nwbfile, partial_fp, workers=write_workers)
+                        print(f'\tWrite NWB 2.0 Zarr store: {save_file_name}')
+                    else:
+                        with NWBHDF5IO(partial_fp.as_posix(), mode='w') as io:
+                            io.write(nwbfile)
+                            print(f'\tWrite NWB 2.0 file: {save_file_name}')
+                    if sharded and plane_data:
+                        link_plane_shards(partial_fp, plane_scans, plane_data)
+                    if dedup and plane_data:
+                        link_duplicates(partial_fp, plane_data, dedup_store_fp)
+                    if checkpoint:
+                        mark_checkpoint(partial_fp)
+                    elif backend == 'hdf5':
+                        write_plane_hashes(partial_fp, plane_hashes)
+            finally:
+                release_shared_arrays(shared_arrays)
+
+        if checkpoint:
+            removed = []
+            for plane, tiff_file in plane_scans:
+                if plane['center_plane'] in finished_planes:
+                    continue
+                # leftovers of a plane interrupted mid-write are dropped before it is appended again
+                removed += remove_planes(partial_fp, [plane['center_plane']])
+                nwbfile = update_nwb_planes(partial_fp, [(plane, tiff_file)], plane_hashes, **plane_kwargs)
+            if removed and needs_repack(partial_fp, repack_threshold):
+                with recorder.stage('repack', bytes_fn=lambda: partial_fp.stat().st_size):
+                    repack_file(partial_fp)
+        publish_file(partial_fp, output_fp, sync_fps=linked_shards(partial_fp) if sharded else ())
+        if sharded:
+            remove_stale_shards(output_fp)
+        if nwbfile is None:
+            # every plane was already in the resumed file, the published file is returned as it is
+            with NWBHDF5IO(output_fp.as_posix(), mode='r') as io:
+                nwbfile = io.read()
+
+        print('\tDone.')
+        return nwbfile
+
+
+def update_nwb_planes(output_fp, plane_scans, plane_hashes, plane_workers=None, shard_output_fp=None,
+                      recorder=None, dedup=False, dedup_store_fp=None, **plane_kwargs):
+    # appends rebuilt planes to an existing file whose stale planes were already removed
+    recorder = recorder or ExportRecorder(None)
+    # duplicates of datasets already in the file are linked to them
+    dedup_index = read_dedup_index(output_fp) if dedup and not dedup_store_fp else None
+    with NWBHDF5IO(output_fp.as_posix(), mode='a') as io:
+        nwbfile = io.read()
+        device = next(iter(nwbfile.devices.values()))
+        ophys_module = nwbfile.processing['ophys']
+        for interface_cls in (MotionCorrection, ImageSegmentation, Fluorescence):
+            if interface_cls.__name__ not in ophys_module.data_interfaces:
+                ophys_module.add(interface_cls())
+        plane_data = add_planes(nwbfile, plane_scans, device,
+                                ophys_module['MotionCorrection'], ophys_module['ImageSegmentation'],
+                                ophys_module['Fluorescence'], plane_workers=plane_workers,
+                                shard_output_fp=shard_output_fp, recorder=recorder,
+                                dedup=dedup, dedup_store_fp=dedup_store_fp, dedup_index=dedup_index,
+                                **plane_kwargs)
+        # removed planes never shrink the file, so its growth is what this update wrote
+        size_before = output_fp.stat().st_size
+        with recorder.stage('write', bytes_fn=lambda: output_fp.stat().st_size - size_before):
+            io.write(nwbfile)
+        print(f'\tUpdated {len(plane_scans)} plane(s) in NWB 2.0 file: {output_fp.name}')
+    if shard_output_fp is not None:
+        link_plane_shards(output_fp, plane_scans, plane_data)
+    if dedup:
+        link_duplicates(output_fp, plane_data, dedup_store_fp)
+    write_plane_hashes(output_fp, {plane['center_plane']: plane_hashes[plane['center_plane']]
+                                   for plane, _ in plane_scans})
+    return nwbfile
+
+
+def add_planes(nwbfile, plane_scans, device, motion_correction, img_seg, fl,
+               stream_corrected=False, corrected_block_size=100, corrected_frame_provider=None,
+               storage_policy=None, dtype_policy=None, embed_raw=False, codec_goal=None, summary_images=False,
+               motion_estimation=False, motion_workers=None, extract_fluorescence=False, neuropil_coefficient=0.7,
+               extraction_workers=None, df_over_f=None, baseline_window=60., baseline_percentile=8., dff_workers=None,
+               segmentation=None, dedup=False, dedup_store_fp=None, dedup_index=None, backend='hdf5', plane_workers=None,
+               shard_output_fp=None, recorder=None, shared_arrays=None):
+    # with shard_output_fp, every plane's heavy datasets are written to its own shard file next to it
+    # with backend='zarr', the arrays shared with the writer's workers are appended to shared_arrays
+    # with dedup, datasets already written (dedup_index of the file, or the store) become placeholders
+    recorder = recorder or ExportRecorder(None)
+    prepare_kwargs = dict(stream_corrected=stream_corrected,
+                          corrected_block_size=corrected_block_size,
+                          corrected_frame_provider=corrected_frame_provider,
+                          storage_policy=storage_policy,
+                          dtype_policy=dtype_policy,
+                          embed_raw=embed_raw,
+                          codec_goal=codec_goal,
+                          summary_images=summary_images,
+                          motion_estimation=motion_estimation,
+                          motion_workers=motion_workers,
+                          extract_fluorescence=extract_fluorescence,
+                          neuropil_coefficient=neuropil_coefficient,
+                          extraction_workers=extraction_workers,
+                          df_over_f=df_over_f,
+                          baseline_window=baseline_window,
+                          baseline_percentile=baseline_percentile,
+                          dff_workers=dff_workers,
+                          segmentation=segmentation)
+
+    # heavy per-plane work runs concurrently, the NWB containers are assembled serially below
+    if shard_output_fp is None:
+        with recorder.stage('prepare_planes'):
+            with ThreadPoolExecutor(max_workers=plane_workers or len(plane_scans)) as executor:
+                plane_data = list(executor.map(
+                    lambda plane_scan: prepare_plane_data(*plane_scan, **prepare_kwargs), plane_scans))
+    else:
+        # HDF5 serializes writes within a process, so the shards are written by worker processes
+        shard_fps = [shard_path(shard_output_fp, plane['center_plane']) for plane, _ in plane_scans]
+        with recorder.stage('prepare_planes', bytes_fn=lambda: sum(fp.stat().st_size for fp in shard_fps)):
+            with ProcessPoolExecutor(max_workers=plane_workers or len(plane_scans)) as executor:
+                plane_data = list(executor.map(partial(export_plane_shard, **prepare_kwargs),
+                                               *zip(*plane_scans), shard_fps))
+            for data, shard_fp in zip(plane_data, shard_fps):
+                data.update(open_plane_shard(shard_fp))
+    if dedup:
+        # duplicates are linked once the file is written, see nwb_dedup.py
+        with recorder.stage('dedup'):
+            deduplicate_planes(plane_scans, plane_data, dedup_index, dedup_store_fp, storage_policy)
+
+    for (plane, _), data in zip(plane_scans, plane_data):
+        print(plane)
+        # with codec_goal every plane carries the storage policy chosen for its data
+        plane_policy = data.get('storage_policy', storage_policy)
+        # the Zarr backend wraps the same datasets for its chunk-parallel writer, see nwb_zarr.py
+        wrap = wrap_dataset if backend == 'hdf5' else partial(zarr_data_io, shared_arrays=shared_arrays)
+        with recorder.stage('imaging_planes'):
+            imaging_plane = nwbfile.create_imaging_plane(name="ImagingPlane"+ '_' + str(plane['center_plane']),
+                                                        # one OpticalChannel per plane: a shared one is
+                                                        # stored in the first plane's group and an update
+                                                        # that removes that plane would take it along
+                                                        optical_channel=OpticalChannel(name="OpticalChannel",
+                                                                                       description="an optical channel",
+                                                                                       emission_lambda=500.
+                                                                                       ),
+                                                        imaging_rate=data['framerate'],
+                                                        description="",
+                                                        device=device,
+                                                        excitation_lambda=600.,
+                                                        indicator="GFP",
+                                                        location="",
+                                                        grid_spacing=(),
+                                                        grid_spacing_unit="",
+                                                        origin_coords=(),
+                                                        origin_coords_unit=""
+                                                        )
+
+            # ==========================================================================
+            # ---------------------------- Insert data file ----------------------------
+            # ==========================================================================
+
+            if 'raw' in data:
+                # self-contained file: the raw frames are streamed into a chunked, compressed dataset
+                image_series = TwoPhotonSeries(name='TwoPhotonSeries2'+'_'+str(plane['center_plane']),
+                                                dimension=list(get_data_shape(data['raw'])[1:]),
+                                                data=wrap(data['raw'], 'raw', plane_policy),
+                                                unit='n.a.',
+                                                imaging_plane=imaging_plane,
+                                                starting_time=0.0,
+                                                rate=1.0
+                                                )
+            else:
+                file_path = np.array(['./k53_20160530_RSM_125um_41mW_zoom2p2_00001_00001.tif'])
+                image_series = TwoPhotonSeries(name='TwoPhotonSeries2'+'_'+str(plane['center_plane']),
+                                                dimension=[100, 100],
+                                                external_file=file_path,
+                                                imaging_plane=imaging_plane,
+                                                starting_frame=[0],
+                                                format='external',
+                                                starting_time=0.0,
+                                                rate=1.0
+                                                )
+            nwbfile.add_acquisition(image_series)
 
         # ==========================================================================
         # --------------------- MotionCorrection information -----------------------
         # ==========================================================================
 
-        corrected = ImageSeries(name='corrected',  
-                                data=np.ones((256,265,1000)),
-                                unit='na',
-                                format='Average projection of motion corrected stack - contrast enhanced (unwarped)', 
-                                starting_time=0.0,
-                                rate=1.0
-                                )
-        x_mocor = np.ones((26100,))
-        y_mocor = np.ones((26100,))
-        xy_translation_data = zip(x_mocor, y_mocor)
-
-        xy_translation = TimeSeries(name='xy_translation',
-                                    data=list(xy_translation_data),
-                                    unit='pixels',
+        with recorder.stage('motion_correction'):
+            corrected = ImageSeries(name='corrected',  
+                                    data=wrap(data['corrected'], 'corrected', plane_policy),
+                                    unit='na',
+                                    format='Average projection of motion corrected stack - contrast enhanced (unwarped)', 
                                     starting_time=0.0,
-                                    rate=1.0,
+                                    rate=1.0
                                     )
+            xy_translation = TimeSeries(name='xy_translation',
+                                        data=wrap(cast_dataset(data['xy_translation'], 'xy_translation',
+                                                               dtype_policy),
+                                                  'xy_translation', plane_policy),
+                                        unit='pixels',
+                                        starting_time=0.0,
+                                        rate=1.0,
+                                        )
 
-        corrected_image_stack = CorrectedImageStack(corrected=corrected,
-                                                    original=image_series,
-                                                    xy_translation=xy_translation,
-                                                    )
+            corrected_image_stack = CorrectedImageStack(name='CorrectedImageStack'+'_'+str(plane['center_plane']),
+                                                        corrected=corrected,
+                                                        original=image_series,
+                                                        xy_translation=xy_translation,
+                                                        )
+
+            motion_correction.add_corrected_image_stack(corrected_image_stack)
 
-        corrected_image_stacks.append(corrected_image_stack)
+            if 'summary_images' in data:
+                nwbfile.processing['ophys'].add(Images(
+                    name='SummaryImages'+'_'+str(plane['center_plane']),
+                    description='projections of the plane computed in one pass over its frames',
+                    images=[GrayscaleImage(name=name, data=data['summary_images'][name],
+                                           description=f'{name} projection over all frames')
+                            for name in SUMMARY_IMAGES]))
 
         # ==========================================================================
         # ----------------------- Segmentation information -------------------------
         # ==========================================================================
 
-        ps = img_seg.create_plane_segmentation(name='PlaneSegmentation'+'_'+str(plane['center_plane']),
-                                            description='output from segmenting the imaging plane',
-                                            imaging_plane=imaging_plane,
-                                            reference_images=image_series  # optional
-                                            )
-
         # ==========================================================================
         # -------------- ROIs (Image masks, Pixel masks) information ---------------
         # ==========================================================================
 
-        cell_ids = np.arange(1,170,1)
-        pixel_masks = []
-        for cell in cell_ids:
-            xpix_corr = np.random.randint(321, 340, 313)
-            ypix_corr = np.random.randint(268, 301, 313)
-            lambda_corr = np.random.uniform(low=0.001, high=0.02, size=(313,))
-            pixel_mask = list(zip(xpix_corr, ypix_corr, lambda_corr))
-            pixel_masks.append(pixel_mask)
-            ps.add_roi(pixel_mask=pixel_masks[0])
+        # all ROIs are ingested at once from the columnar pixel mask arrays
+        with recorder.stage('segmentation'):
+            ps = create_plane_segmentation_bulk(img_seg,
+                                                data['pixel_mask'],
+                                                data['mask_offsets'],
+                                                name='PlaneSegmentation'+'_'+str(plane['center_plane']),
+                                                description='output from segmenting the imaging plane',
+                                                imaging_plane=imaging_plane,
+                                                reference_images=image_series  # optional
+                                                )
+            if backend == 'hdf5':
+                wrap_column(ps, 'pixel_mask', 'pixel_mask', plane_policy)
+            if 'shard' in data:
+                defer_pixel_mask(ps)
+            add_timestamp_offsets(ps, data['timestamp_offsets'])
 
         # ==========================================================================
         # ----------------------- Flourescence information -------------------------
         # ==========================================================================
 
-        raw_fluo_traces = np.random.random((26100, 170))
+        with recorder.stage('fluorescence'):
+            roi_region = ps.create_roi_table_region(region=list(range(len(data['cell_ids']))),
+                                                    description='list of ROIs'
+                                                    )
 
-        timestamps = np.random.random((26100, 170))
-        timestamps = np.vstack(timestamps)
-        raw_fluo_traces = np.vstack(raw_fluo_traces).T
-        timestamps = np.vstack(timestamps).T
+            # per-ROI timestamps are timestamps + the ROI's timestamp_offset, see roi_utils.roi_timestamps
+            raw_fluo_series = RoiResponseSeries(name='RawfluorescenceResponseSeries'+'_'+str(plane['center_plane']),
+                                                data=wrap(data['raw_fluo_traces'], 'roi_response', plane_policy),
+                                                description='Raw fluorescence trace',
+                                                rois=roi_region,
+                                                unit='a.u.',
+                                                timestamps=data['timestamps'])
+            fl.add_roi_response_series(raw_fluo_series)
 
-        roi_region = ps.create_roi_table_region(region=list(range(len(cell_ids))),
-                                                description='list of ROIs'
-                                                )
+            if 'fluo_traces' in data:
+                fluo_series = RoiResponseSeries(name='NeuropilCorrectedResponseSeries'+'_'+str(plane['center_plane']),
+                                                data=wrap(data['fluo_traces'], 'roi_response', plane_policy),
+                                                description=f'Raw fluorescence minus {neuropil_coefficient} x '
+                                                            f'neuropil fluorescence',
+                                                rois=roi_region,
+                                                unit='a.u.',
+                                                timestamps=raw_fluo_series)
+                fl.add_roi_response_series(fluo_series)
 
-        # TODO: Can timestamps be stored as an 2d array instead of just 1D
-        roi_resp_series.append(RoiResponseSeries(name='RawfluorescenceResponseSeries'+'_'+str(plane['center_plane']),
-                                            data=raw_fluo_traces,
-                                            description='Raw fluorescence trace',
-                                            rois=roi_region,
-                                            unit='a.u.',
-                                            timestamps=timestamps))
-
-    motion_correction = MotionCorrection(corrected_image_stacks=corrected_image_stacks)
-    ophys_module.add(motion_correction)
-    ophys_module.add(img_seg)
-    fl = Fluorescence(roi_response_series=roi_resp_series)
-    ophys_module.add(fl)
-    # ------------------------ Write to .nwb -------------------
-    output_dir = pathlib.Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
+            if 'dff_traces' in data:
+                # one DfOverF interface next to Fluorescence, created with the first plane that needs it
+                ophys_module = nwbfile.processing['ophys']
+                if 'DfOverF' not in ophys_module.data_interfaces:
+                    ophys_module.add(DfOverF())
+                dff_series = RoiResponseSeries(name='DfOverFResponseSeries'+'_'+str(plane['center_plane']),
+                                               data=wrap(data['dff_traces'], 'roi_response', plane_policy),
+                                               description=f'dF/F, {df_over_f} baseline over {baseline_window} s'
+                                                           + (f' (percentile {baseline_percentile})'
+                                                              if df_over_f == 'percentile' else ''),
+                                               rois=roi_region,
+                                               unit='n.a.',
+                                               timestamps=raw_fluo_series)
+                ophys_module['DfOverF'].add_roi_response_series(dff_series)
 
-    save_file_name = ''.join([nwbfile.identifier, '.nwb'])
-    output_fp = (output_dir / save_file_name).absolute()
-    if overwrite or not output_fp.exists():
-        with NWBHDF5IO(output_fp.as_posix(), mode='w') as io:
-            io.write(nwbfile)
-            print(f'\tWrite NWB 2.0 file: {save_file_name}')
+        # series whose data is linked from the plane's shard, see link_plane_shards
+        data['linked_series'] = {'corrected': corrected, 'xy_translation': xy_translation,
+                                 'raw_fluo_traces': raw_fluo_series}
+        if 'raw' in data:
+            data['linked_series']['raw'] = image_series
+        if 'fluo_traces' in data:
+            data['linked_series']['fluo_traces'] = fluo_series
+        if 'dff_traces' in data:
+            data['linked_series']['dff_traces'] = dff_series
+
+        if 'codec_selection' in data:
+            nwbfile.add_scratch(json.dumps(data['codec_selection']),
+                                name='codec_selection'+'_'+str(plane['center_plane']),
+                                description='codec chosen for each dataset of the plane and the trial '
+                                            'compression measurements of every candidate')
+    return plane_data
+
+
+def link_plane_shards(nwb_fp, plane_scans, plane_data):
+    # the shards were held open while the NWB file was written, they are finished once linked
+    for (plane, _), data in zip(plane_scans, plane_data):
+        shard_fp = data['shard'].filename
+        data['shard'].close()
+        link_plane_shard(nwb_fp, shard_fp, plane['center_plane'], data['linked_series'])
 
-    print('\tDone.')
-    return nwbfile
 
-def write_nwb_files(session_keys, output_dir='./', overwrite=True):
-    for session_key in session_keys:
-        export_to_nwb(session_key, output_dir=output_dir, overwrite=overwrite)
\ No newline at end of file
+def write_nwb_files(session_keys, output_dir='./', overwrite=True, num_workers=None, max_memory_bytes=None,
+                    stats_path=None, metadata_source=None, metadata_batch_size=32, plan=False, calibration=None,
+                    **export_kwargs):
+    # with stats_path, every export appends its per-stage record and the batch is summarized at the end
+    # with metadata_source, session/subject/plane metadata is fetched metadata_batch_size sessions per query
+    # with plan=True, nothing is exported: the plan of every session is returned (see export_plan.py)
+    if plan:
+        records = metadata_source.fetch_all(session_keys, metadata_batch_size) if metadata_source else {}
+        plans = [export_to_nwb(session_key, output_dir=output_dir, overwrite=overwrite, plan=True,
+                               calibration=calibration, metadata=records.get(session_id(session_key)),
+                               **export_kwargs)
+                 for session_key in session_keys]
+        print(f'Planned {len(plans)} sessions: {sum(p["file_bytes"] for p in plans) / 1e9:.2f} GB, '
+              f'largest peak memory {max((p["peak_memory_bytes"] for p in plans), default=0) / 1e9:.2f} GB, '
+              f'write {sum(p["write_seconds"] for p in plans):.0f}s')
+        return plans
+    if stats_path:
+        export_kwargs['stats_path'] = stats_path
+        export_kwargs['stats_tags'] = {'batch_id': f'{datetime.now().isoformat()}-{os.getpid()}'}
+    if num_workers is not None:
+        # one process and one output file per session, failures are reported per session; the
+        # metadata of all sessions is fetched up front and sent along with each session
+        records = metadata_source.fetch_all(session_keys, metadata_batch_size) if metadata_source else None
+        # sessions are started largest first and packed by peak memory, both predicted by the dry-run
+        # plan of their own planes and scans (metadata only, see export_plan.py)
+        plans = {session_id(session_key): export_to_nwb(
+            session_key, output_dir=output_dir, overwrite=overwrite, plan=True, calibration=calibration,
+            metadata=records[session_id(session_key)] if records else None,
+            **export_kwargs) for session_key in session_keys}
+        results, summary = run_parallel_export(export_to_nwb, session_keys, output_dir=output_dir,
+                                               overwrite=overwrite, num_workers=num_workers,
+                                               size_fn=lambda session_key: plans[session_id(session_key)]['file_bytes'],
+                                               memory_fn=lambda session_key:
+                                               plans[session_id(session_key)]['peak_memory_bytes'],
+                                               max_memory_bytes=max_memory_bytes,
+                                               session_kwargs_fn=(lambda session_key: {
+                                                   'metadata': records[session_id(session_key)]})
+                                               if records else None,
+                                               **export_kwargs)
+    else:
+        # the next batch of metadata is fetched while the current sessions are exported
+        prefetcher = MetadataPrefetcher(metadata_source, session_keys, metadata_batch_size) \
+            if metadata_source else None
+        try:
+            for session_key in session_keys:
+                metadata = prefetcher.get(session_key) if prefetcher else None
+                export_to_nwb(session_key, output_dir=output_dir, overwrite=overwrite, metadata=metadata,
+                              **export_kwargs)
+                # frees the session's arrays, held in the reference cycles of its containers
+                gc.collect()
+        finally:
+            if prefetcher:
+                prefetcher.close()
+        results, summary = None, None
+    if stats_path:
+        stages = aggregate_records(load_records(stats_path, **export_kwargs['stats_tags']))
+        print_aggregate(stages)
+        if summary is None:
+            return stages
+        summary['stages'] = stages
+    if summary is not None:
+        return results, summary
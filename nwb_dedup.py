@@ -0,0 +1,166 @@
+import fcntl
+import hashlib
+import json
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+
+from nwb_reader import SERIES_PATHS
+from nwb_shards import SHARD_DATASETS, write_shard_dataset
+from nwb_storage import dataset_options
+from scan_utils import PageFrameReader, ScanFrameIterator, read_frame_block, scan_cache_key
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+# ==========================================================================
+# ------------------------ Content-hash deduplication ----------------------
+# ==========================================================================
+# With dedup, every heavy dataset of a plane gets a fingerprint: a hash of its bytes, dtype and shape
+# for arrays, or of its source (scan path/size/mtime, field, dtype) for stacks streamed from the raw
+# frames of a scan. A dataset whose fingerprint was already written is neither read nor written
+# again: the NWB file gets an empty placeholder, replaced once the file is written by
+#   dedup=True          : a hard link to the first copy in the same file
+#   dedup='<store.h5>'  : an external link into a shared store holding every fingerprinted dataset
+#                         once, under its fingerprint, for all the files that use it
+# The fingerprint -> dataset paths index of a file is a JSON attribute of its root group, so updates
+# and checkpointed planes link to the copies written before them.
+
+DEDUP_INDEX_ATTR = 'dedup_index'
+
+# arrays smaller than this are written as they are, a link would not save anything
+DEDUP_MIN_BYTES = 2**20
+
+
+def content_hash(array):
+    array = np.ascontiguousarray(array)
+    digest = xxhash.xxh3_128() if xxhash else hashlib.sha1()
+    digest.update(json.dumps([array.dtype.str, array.shape]).encode())
+    digest.update(memoryview(array.reshape(-1)).cast('B'))
+    return digest.hexdigest()
+
+
+def fingerprint(data):
+    # None for data that is not deduplicated: small arrays, frames of custom frame providers
+    if isinstance(data, ScanFrameIterator):
+        if not isinstance(data.frame_provider, PageFrameReader) and data.frame_provider is not read_frame_block:
+            return None
+        source = {'scan': [scan_cache_key(filename) for filename in data.scan.filenames],
+                  'field': data.field,
+                  'dtype': data.dtype.str}
+        return 'scan-' + hashlib.sha1(json.dumps(source, sort_keys=True).encode()).hexdigest()
+    if isinstance(data, np.ndarray) and data.nbytes >= DEDUP_MIN_BYTES:
+        return content_hash(data)
+    return None
+
+
+def placeholder(data):
+    # empty dataset of the same dtype written in place of a duplicate, see link_duplicates
+    shape = data.maxshape if isinstance(data, ScanFrameIterator) else data.shape
+    return np.empty((0,) + tuple(shape[1:]), dtype=data.dtype)
+
+
+def dataset_path(name, center_plane):
+    return SERIES_PATHS[name].format(center_plane=center_plane) + '/data'
+
+
+@contextmanager
+def store_lock(store_fp):
+    # exports of other sessions may add to the same store
+    with open(f'{store_fp}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_dedup_index(nwb_fp):
+    # fingerprint -> paths of its dataset, left out when none of them exists anymore (removed planes)
+    if not pathlib.Path(nwb_fp).exists():
+        return {}
+    with h5py.File(nwb_fp, 'r') as f:
+        index = json.loads(f.attrs.get(DEDUP_INDEX_ATTR, '{}'))
+        index = {key: [path for path in paths if path in f] for key, paths in index.items()}
+    return {key: paths for key, paths in index.items() if paths}
+
+
+def deduplicate_planes(plane_scans, plane_data, index=None, store_fp=None, storage_policy=None):
+    """Replace the duplicates among the planes' datasets by placeholders.
+
+    plane_data is modified in place: every plane gets 'dedup_links' ({path: (kind, target)}, kind
+    'hard' or 'store') and 'dedup_written' ({fingerprint: path} of the copies it writes itself).
+    With store_fp, missing datasets are written to the store here.
+    """
+    index = {key: list(paths) for key, paths in (index or {}).items()}
+    candidates = [(data, name, plane['center_plane']) for (plane, _), data in zip(plane_scans, plane_data)
+                  for name in SERIES_PATHS if name in data and not isinstance(data[name], h5py.Dataset)]
+    # hashing releases the GIL, large arrays are hashed concurrently
+    with ThreadPoolExecutor() as executor:
+        keys = list(executor.map(lambda candidate: fingerprint(candidate[0][candidate[1]]), candidates))
+    for data in plane_data:
+        data['dedup_links'], data['dedup_written'] = {}, {}
+
+    if store_fp is None:
+        for (data, name, center_plane), key in zip(candidates, keys):
+            if key is None:
+                continue
+            key = f'{name}-{key}'
+            path = dataset_path(name, center_plane)
+            if key in index:
+                data['dedup_links'][path] = ('hard', index[key][0])
+                data[name] = placeholder(data[name])
+            else:
+                index[key] = [path]
+                data['dedup_written'][key] = path
+        return plane_data
+
+    with store_lock(store_fp), h5py.File(store_fp, 'a') as store:
+        for (data, name, center_plane), key in zip(candidates, keys):
+            if key is None:
+                continue
+            key = f'{name}/{key}'
+            if key not in store:
+                shape = data[name].maxshape if isinstance(data[name], ScanFrameIterator) else data[name].shape
+                options = dataset_options(data.get('storage_policy', storage_policy), SHARD_DATASETS[name], shape)
+                write_shard_dataset(store, key, data[name], options)
+            data['dedup_links'][dataset_path(name, center_plane)] = ('store', key)
+            data[name] = placeholder(data[name])
+    return plane_data
+
+
+def link_duplicates(nwb_fp, plane_data, store_fp=None):
+    # runs on the written file: placeholders become links, the attributes pynwb wrote on them go to
+    # store datasets that have none yet (hard links share the attributes of the first copy)
+    links = {path: link for data in plane_data for path, link in data.get('dedup_links', {}).items()}
+    written = {key: path for data in plane_data for key, path in data.get('dedup_written', {}).items()}
+    store_attrs = {}
+    with h5py.File(nwb_fp, 'r+') as f:
+        index = json.loads(f.attrs.get(DEDUP_INDEX_ATTR, '{}'))
+        index = {key: [path for path in paths if path in f] for key, paths in index.items()}
+        for key, path in written.items():
+            index[key] = [path] + [other for other in index.get(key, []) if other != path]
+        for path, (kind, target) in links.items():
+            attrs = dict(f[path].attrs)
+            del f[path]
+            if kind == 'hard':
+                f[path] = f[target]
+                key = next(key for key, paths in index.items() if target in paths)
+                index[key].append(path)
+            else:
+                f[path] = h5py.ExternalLink(os.path.relpath(store_fp, pathlib.Path(nwb_fp).parent), target)
+                store_attrs[target] = attrs
+        f.attrs[DEDUP_INDEX_ATTR] = json.dumps({key: paths for key, paths in index.items() if paths})
+    if store_attrs:
+        with store_lock(store_fp), h5py.File(store_fp, 'r+') as store:
+            for target, attrs in store_attrs.items():
+                if not store[target].attrs:
+                    store[target].attrs.update(attrs)
+    return links
@@ -0,0 +1,250 @@
+import itertools
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+try:
+    import hdf5plugin  # noqa: F401  (registers the Blosc / Zstd filters chosen by codec_goal)
+except ImportError:
+    hdf5plugin = None
+
+
+# ==========================================================================
+# ------------------- Windowed reads of exported sessions ------------------
+# ==========================================================================
+# SessionReader opens a file written by export_to_nwb with h5py only. On open it indexes every
+# plane: its series (dataset path, shape, time range) and the ROI ids of its traces. Queries are
+# served by hyperslab reads of whole chunks, which stay in a byte-bounded LRU cache, so repeated
+# window queries over the same session are answered from memory.
+#
+#   with SessionReader('session.nwb', cache_bytes=512 * 2**20) as reader:
+#       traces = reader.traces(0, roi_ids=range(10, 20), frames=(1000, 2000))
+#       frames = reader.frames(0, 'corrected', times=(30., 45.))
+
+# plane series -> group of the series, by center_plane
+SERIES_PATHS = {'raw': 'acquisition/TwoPhotonSeries2_{center_plane}',
+                'corrected': 'processing/ophys/MotionCorrection/CorrectedImageStack_{center_plane}/corrected',
+                'xy_translation': 'processing/ophys/MotionCorrection/CorrectedImageStack_{center_plane}/'
+                                  'xy_translation',
+                'raw_fluo_traces': 'processing/ophys/Fluorescence/RawfluorescenceResponseSeries_{center_plane}',
+                'fluo_traces': 'processing/ophys/Fluorescence/NeuropilCorrectedResponseSeries_{center_plane}',
+                'dff_traces': 'processing/ophys/DfOverF/DfOverFResponseSeries_{center_plane}'}
+PLANE_SEGMENTATION_PATH = 'processing/ophys/ImageSegmentation/PlaneSegmentation_{center_plane}'
+SUMMARY_IMAGES_PATH = 'processing/ophys/SummaryImages_{center_plane}'
+IMAGING_PLANE_PREFIX = 'ImagingPlane_'
+
+# rows read at once from contiguous (unchunked) datasets
+CONTIGUOUS_BLOCK_BYTES = 2**20
+
+
+class ChunkCache:
+    """LRU cache of dataset chunks, bounded by the total bytes held."""
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = self.misses = 0
+        self._chunks = OrderedDict()
+
+    def get(self, key, read):
+        # read() is only called on a miss; least recently used chunks are evicted beyond max_bytes
+        if key in self._chunks:
+            self.hits += 1
+            self._chunks.move_to_end(key)
+            return self._chunks[key]
+        self.misses += 1
+        chunk = read()
+        if chunk.nbytes <= self.max_bytes:
+            self._chunks[key] = chunk
+            self.num_bytes += chunk.nbytes
+            while self.num_bytes > self.max_bytes:
+                self.num_bytes -= self._chunks.popitem(last=False)[1].nbytes
+        return chunk
+
+    def clear(self):
+        self._chunks.clear()
+        self.num_bytes = 0
+
+    def stats(self):
+        return {'chunks': len(self._chunks), 'bytes': self.num_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+def read_grid(dset):
+    # the dataset's chunk shape, or row blocks of about CONTIGUOUS_BLOCK_BYTES for contiguous datasets
+    if dset.chunks is not None:
+        return dset.chunks
+    row_bytes = max(1, int(np.prod(dset.shape[1:], dtype=np.int64)) * dset.dtype.itemsize)
+    return (max(1, CONTIGUOUS_BLOCK_BYTES // row_bytes),) + tuple(dset.shape[1:])
+
+
+def series_time_range(group, num_frames):
+    # first and last sample time from the timestamps, or from starting_time and rate
+    if 'timestamps' in group:
+        timestamps = group['timestamps'][...]
+        return {'timestamps': timestamps, 'start': float(timestamps[0]) if len(timestamps) else 0.,
+                'stop': float(timestamps[-1]) if len(timestamps) else 0.}
+    starting_time = float(group['starting_time'][()]) if 'starting_time' in group else 0.
+    rate = float(group['starting_time'].attrs.get('rate', 1.)) if 'starting_time' in group else 1.
+    return {'starting_time': starting_time, 'rate': rate,
+            'start': starting_time, 'stop': starting_time + max(num_frames - 1, 0) / rate}
+
+
+def index_session(f):
+    # {center_plane: {'series': {name: {'path', 'shape', 'dtype', 'start', 'stop', ...}}, 'roi_ids': array,
+    #                 'images': [summary image names]}
+    planes = {}
+    for name in sorted(f['general/optophysiology']):
+        if not name.startswith(IMAGING_PLANE_PREFIX):
+            continue
+        center_plane = int(name[len(IMAGING_PLANE_PREFIX):])
+        series = {}
+        for series_name, path in SERIES_PATHS.items():
+            path = path.format(center_plane=center_plane)
+            # external TwoPhotonSeries (frames left in the tiff) have no frames to read
+            if path not in f or 'data' not in f[path] or 'external_file' in f[path]:
+                continue
+            dset = f[path]['data']
+            series[series_name] = dict(series_time_range(f[path], dset.shape[0]),
+                                       path=f'{path}/data', shape=dset.shape, dtype=dset.dtype)
+        images_path = SUMMARY_IMAGES_PATH.format(center_plane=center_plane)
+        plane = {'series': series, 'roi_ids': None, 'images': sorted(f[images_path]) if images_path in f else []}
+        traces_path = SERIES_PATHS['raw_fluo_traces'].format(center_plane=center_plane)
+        segmentation_path = PLANE_SEGMENTATION_PATH.format(center_plane=center_plane)
+        if traces_path in f and segmentation_path in f:
+            # trace column j holds the ROI in row rois[j] of the PlaneSegmentation
+            plane['roi_ids'] = f[segmentation_path]['id'][...][f[traces_path]['rois'][...]]
+        planes[center_plane] = plane
+    return planes
+
+
+class SessionReader:
+    """Window queries on one exported session, see the module comment."""
+
+    def __init__(self, nwb_fp, cache_bytes=256 * 2**20):
+        self.nwb_fp = nwb_fp
+        self.file = h5py.File(nwb_fp, 'r')
+        self.planes = index_session(self.file)
+        self.cache = ChunkCache(cache_bytes)
+        self._datasets = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.cache.clear()
+        self._datasets = {}
+        self.file.close()
+
+    def series(self, center_plane, name):
+        try:
+            return self.planes[center_plane]['series'][name]
+        except KeyError:
+            raise KeyError(f'No series {name!r} for plane {center_plane} in {self.nwb_fp}') from None
+
+    def dataset(self, path):
+        # datasets (also external links into plane shards) are opened once per reader
+        if path not in self._datasets:
+            self._datasets[path] = self.file[path]
+        return self._datasets[path]
+
+    # ----- Time and ROI lookups -----
+
+    def frame_range(self, center_plane, name, times):
+        # [start, stop) of the frames sampled within times=(t0, t1), both ends included
+        info = self.series(center_plane, name)
+        t0, t1 = times
+        if 'timestamps' in info:
+            return (int(np.searchsorted(info['timestamps'], t0, side='left')),
+                    int(np.searchsorted(info['timestamps'], t1, side='right')))
+        start = int(np.ceil((t0 - info['starting_time']) * info['rate'] - 1e-9))
+        stop = int(np.floor((t1 - info['starting_time']) * info['rate'] + 1e-9)) + 1
+        num_frames = info['shape'][0]
+        return min(max(start, 0), num_frames), min(max(stop, 0), num_frames)
+
+    def roi_columns(self, center_plane, roi_ids):
+        # trace columns of the given ROI ids, in the order asked for
+        ids = self.planes[center_plane]['roi_ids']
+        if ids is None:
+            raise KeyError(f'No ROIs for plane {center_plane} in {self.nwb_fp}')
+        order = np.argsort(ids, kind='stable')
+        roi_ids = np.asarray(list(roi_ids), dtype=ids.dtype)
+        positions = np.searchsorted(ids, roi_ids, sorter=order)
+        positions = np.minimum(positions, len(ids) - 1)
+        columns = order[positions]
+        missing = roi_ids[ids[columns] != roi_ids]
+        if len(missing):
+            raise KeyError(f'Unknown ROI ids {missing.tolist()} for plane {center_plane}')
+        return columns
+
+    # ----- Hyperslab reads through the chunk cache -----
+
+    def read(self, path, selection):
+        # selection: one (start, stop) per leading axis, the remaining axes are read whole
+        dset = self.dataset(path)
+        bounds = [(max(start, 0), min(stop, size)) for (start, stop), size in zip(selection, dset.shape)]
+        bounds += [(0, size) for size in dset.shape[len(bounds):]]
+        out = np.empty(tuple(max(stop - start, 0) for start, stop in bounds), dtype=dset.dtype)
+        if out.size == 0:
+            return out
+        grid = read_grid(dset)
+        chunk_ranges = [range(start // step, (stop - 1) // step + 1) for (start, stop), step in zip(bounds, grid)]
+        for chunk_index in itertools.product(*chunk_ranges):
+            chunk_start = [i * step for i, step in zip(chunk_index, grid)]
+            chunk = self.cache.get((path, chunk_index), lambda: self.read_chunk(dset, chunk_start, grid))
+            source, target = [], []
+            for (start, stop), first, size in zip(bounds, chunk_start, chunk.shape):
+                lo, hi = max(start, first), min(stop, first + size)
+                source.append(slice(lo - first, hi - first))
+                target.append(slice(lo - start, hi - start))
+            out[tuple(target)] = chunk[tuple(source)]
+        return out
+
+    @staticmethod
+    def read_chunk(dset, chunk_start, grid):
+        selection = tuple(slice(first, min(first + step, size))
+                          for first, step, size in zip(chunk_start, grid, dset.shape))
+        chunk = np.empty(tuple(s.stop - s.start for s in selection), dtype=dset.dtype)
+        dset.read_direct(chunk, source_sel=selection)
+        return chunk
+
+    # ----- Queries -----
+
+    def window(self, center_plane, name, frames=None, times=None):
+        # frames=(start, stop) or times=(t0, t1) of one series, all frames by default
+        info = self.series(center_plane, name)
+        if times is not None:
+            frames = self.frame_range(center_plane, name, times)
+        frames = frames or (0, info['shape'][0])
+        return info, frames
+
+    def frames(self, center_plane, name='corrected', frames=None, times=None):
+        info, frames = self.window(center_plane, name, frames=frames, times=times)
+        return self.read(info['path'], [frames])
+
+    def traces(self, center_plane, roi_ids=None, frames=None, times=None, name='raw_fluo_traces'):
+        # (frames, rois) traces of roi_ids (all ROIs by default) over a frame or time window
+        info, frames = self.window(center_plane, name, frames=frames, times=times)
+        if roi_ids is None:
+            return self.read(info['path'], [frames])
+        columns = self.roi_columns(center_plane, roi_ids)
+        if len(columns) == 0:
+            return np.empty((max(frames[1] - frames[0], 0), 0), dtype=info['dtype'])
+        # one read of the column span, then the ROIs are picked from it
+        block = self.read(info['path'], [frames, (int(columns.min()), int(columns.max()) + 1)])
+        return block[:, columns - columns.min()]
+
+    def image(self, center_plane, name='mean'):
+        # a (height, width) summary image (mean, max, std, correlation) of the plane
+        if name not in self.planes[center_plane]['images']:
+            raise KeyError(f'No summary image {name!r} for plane {center_plane} in {self.nwb_fp}')
+        return self.file[SUMMARY_IMAGES_PATH.format(center_plane=center_plane)][name][...]
+
+    def timestamps(self, center_plane, name='raw_fluo_traces', frames=None, times=None):
+        info, frames = self.window(center_plane, name, frames=frames, times=times)
+        if 'timestamps' in info:
+            return info['timestamps'][frames[0]:frames[1]]
+        return info['starting_time'] + np.arange(*frames) / info['rate']
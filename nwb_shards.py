@@ -0,0 +1,129 @@
+import glob
+import os
+import pathlib
+import uuid
+
+import h5py
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator
+
+from nwb_storage import cast_dataset, dataset_options
+
+
+# ==========================================================================
+# ---------------------- Sharded per-plane output files --------------------
+# ==========================================================================
+# With sharded=True the heavy datasets of every plane (corrected stack, xy shifts, raw traces and
+# pixel masks) are written to their own HDF5 file next to the NWB file, one worker process per
+# plane. The NWB file only holds metadata and external links into the shards, so it opens like
+# any other NWB file as long as the shards are kept in the same directory.
+
+# shard dataset name -> storage/dtype policy role; 'raw' only when the raw movie is embedded
+SHARD_DATASETS = {'raw': 'raw',
+                  'corrected': 'corrected',
+                  'xy_translation': 'xy_translation',
+                  'raw_fluo_traces': 'roi_response',
+                  'fluo_traces': 'roi_response',
+                  'dff_traces': 'roi_response',
+                  'pixel_mask': 'pixel_mask'}
+
+# attributes pynwb writes on TimeSeries.data; hdmf links external datasets without them
+SERIES_DATA_ATTRS = ('unit', 'conversion', 'resolution', 'offset', 'continuity')
+
+PIXEL_MASK_PATH = 'processing/ophys/ImageSegmentation/PlaneSegmentation_{center_plane}/pixel_mask'
+
+
+# Every shard written gets a new name (<file>_plane<center_plane>_<token>.h5): the published NWB file
+# keeps linking to its own shards while an export or update writes new ones, and renaming the NWB
+# file into place switches all of them at once. Shards no longer linked are removed after that.
+
+def shard_path(output_fp, center_plane, token=None):
+    output_fp = pathlib.Path(output_fp)
+    token = token or uuid.uuid4().hex[:8]
+    return output_fp.with_name(f'{output_fp.stem}_plane{center_plane}_{token}.h5')
+
+
+def linked_shards(nwb_fp):
+    # absolute paths of the files the NWB file links to: external links and virtual dataset sources
+    nwb_fp = pathlib.Path(nwb_fp)
+    filenames = set()
+
+    def visit(group):
+        for name in group:
+            link = group.get(name, getlink=True)
+            if isinstance(link, h5py.ExternalLink):
+                filenames.add(link.filename)
+            elif isinstance(link, h5py.HardLink):
+                obj = group[name]
+                if isinstance(obj, h5py.Group):
+                    visit(obj)
+                elif obj.is_virtual:
+                    filenames.update(source.file_name for source in obj.virtual_sources())
+
+    with h5py.File(nwb_fp, 'r') as f:
+        visit(f)
+    return {(nwb_fp.parent / filename).resolve() for filename in filenames}
+
+
+def remove_stale_shards(output_fp):
+    # shards of output_fp it does not link to: replaced planes, or planes of an export that crashed
+    output_fp = pathlib.Path(output_fp)
+    linked = linked_shards(output_fp)
+    for shard_fp in output_fp.parent.glob(f'{glob.escape(output_fp.stem)}_plane*.h5'):
+        if shard_fp.resolve() not in linked:
+            shard_fp.unlink()
+
+
+def write_shard_dataset(f, name, data, options):
+    if isinstance(data, AbstractDataChunkIterator):
+        # streamed stacks are written buffer by buffer, like NWBHDF5IO does
+        dset = f.create_dataset(name, shape=data.maxshape, dtype=data.dtype, **options)
+        for chunk in data:
+            dset[chunk.selection] = chunk.data
+        return dset
+    return f.create_dataset(name, data=data, **options)
+
+
+def write_plane_shard(shard_fp, data, storage_policy=None, dtype_policy=None):
+    data = dict(data, xy_translation=cast_dataset(data['xy_translation'], 'xy_translation', dtype_policy))
+    with h5py.File(shard_fp, 'w') as f:
+        for name, role in SHARD_DATASETS.items():
+            if name not in data:
+                continue
+            shape = data[name].maxshape if isinstance(data[name], AbstractDataChunkIterator) else data[name].shape
+            write_shard_dataset(f, name, data[name], dataset_options(storage_policy, role, shape))
+
+
+def open_plane_shard(shard_fp):
+    # the shard stays open until the NWB file is written, hdmf links its datasets instead of copying them
+    f = h5py.File(shard_fp, 'r')
+    return dict({name: f[name] for name in SHARD_DATASETS if name in f}, shard=f)
+
+
+def defer_pixel_mask(plane_segmentation):
+    # compound datasets are always copied row by row by hdmf, so the pixel_mask column is written as an
+    # empty placeholder and mapped onto the shard in link_plane_shard
+    column = plane_segmentation['pixel_mask'].target
+    column.transform(lambda data: np.empty(0, dtype=data.dtype))
+
+
+def link_plane_shard(nwb_fp, shard_fp, center_plane, linked_series):
+    # runs on the written NWB file: copies the attributes hdmf left out onto the linked shard datasets
+    # and turns the pixel_mask placeholder into a virtual dataset backed by the shard. A virtual
+    # dataset (not an external link) because pixel_mask_index holds an object reference to it.
+    source_fp = os.path.relpath(shard_fp, pathlib.Path(nwb_fp).parent)
+    mask_path = PIXEL_MASK_PATH.format(center_plane=center_plane)
+    with h5py.File(nwb_fp, 'r+') as f, h5py.File(shard_fp, 'r+') as shard:
+        for name, series in linked_series.items():
+            for attr in SERIES_DATA_ATTRS:
+                value = getattr(series, attr, None)
+                if value is not None:
+                    shard[name].attrs[attr] = value
+        masks = shard['pixel_mask']
+        attrs = dict(f[mask_path].attrs)
+        del f[mask_path]
+        layout = h5py.VirtualLayout(shape=masks.shape, dtype=masks.dtype)
+        layout[:] = h5py.VirtualSource(source_fp, 'pixel_mask', shape=masks.shape, dtype=masks.dtype)
+        f.create_virtual_dataset(mask_path, layout)
+        f[mask_path].attrs.update(attrs)
+        f[f'{mask_path}_index'].attrs['target'] = f[mask_path].ref
@@ -0,0 +1,159 @@
+import copy
+
+import h5py
+import numpy as np
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+from hdmf.utils import get_data_shape
+
+
+# ==========================================================================
+# -------------------------- HDF5 storage policies -------------------------
+# ==========================================================================
+# A storage policy maps each large dataset written by export_to_nwb to the HDF5
+# options it is written with:
+#   'corrected'      : CorrectedImageStack.corrected  (frames, height, width)
+#   'xy_translation' : CorrectedImageStack.xy_translation  (frames, 2)
+#   'roi_response'   : RoiResponseSeries traces  (frames, rois)
+#   'pixel_mask'     : PlaneSegmentation pixel_mask column  (total pixels,)
+#   'raw'            : TwoPhotonSeries frames when the raw movie is embedded  (frames, height, width)
+# Chunk dimensions given as None span the whole dataset along that axis.
+# Datasets without an entry are written contiguous and uncompressed, except embedded raw movies,
+# which default to DEFAULT_OPTIONS['raw'].
+
+_GZIP = dict(compression='gzip', compression_opts=4, shuffle=True)
+
+STORAGE_PRESETS = {
+    'contiguous': {},
+    # long single-ROI traces and small spatial patches over time
+    'per_roi_reads': {
+        'corrected': dict(chunks=(250, 32, 32), **_GZIP),
+        'xy_translation': dict(chunks=(None, None), **_GZIP),
+        'roi_response': dict(chunks=(None, 1), **_GZIP),
+        'pixel_mask': dict(chunks=(65536,), **_GZIP),
+        'raw': dict(chunks=(250, 32, 32), **_GZIP),
+    },
+    # whole frames and all ROIs at a time point
+    'per_frame_reads': {
+        'corrected': dict(chunks=(1, None, None), **_GZIP),
+        'xy_translation': dict(chunks=(None, None), **_GZIP),
+        'roi_response': dict(chunks=(256, None), **_GZIP),
+        'pixel_mask': dict(chunks=(65536,), **_GZIP),
+        'raw': dict(chunks=(1, None, None), **_GZIP),
+    },
+}
+
+DEFAULT_OPTIONS = {'raw': dict(chunks=(1, None, None), **_GZIP)}
+
+
+def make_storage_policy(preset='contiguous', **overrides):
+    # e.g. make_storage_policy('per_roi_reads', corrected=dict(chunks=(1, None, None), compression='lzf'))
+    if preset not in STORAGE_PRESETS:
+        raise ValueError(f'Unknown storage preset {preset!r}, choose one of {sorted(STORAGE_PRESETS)}')
+    policy = copy.deepcopy(STORAGE_PRESETS[preset])
+    policy.update(overrides)
+    return policy
+
+
+def resolve_storage_policy(policy):
+    if policy is None:
+        return {}
+    if isinstance(policy, str):
+        return make_storage_policy(policy)
+    return policy
+
+
+def resolve_chunks(chunks, shape):
+    # None -> full extent, and never larger than the dataset itself
+    return tuple(max(1, min(size if chunk is None else chunk, size))
+                 for chunk, size in zip(chunks, shape))
+
+
+def role_options(policy, role):
+    return dict(resolve_storage_policy(policy).get(role) or DEFAULT_OPTIONS.get(role) or {})
+
+
+def policy_chunks(policy, role, shape):
+    options = role_options(policy, role)
+    if options.get('chunks') is None:
+        return None
+    return resolve_chunks(options['chunks'], shape)
+
+
+def dataset_options(policy, role, shape):
+    # the policy entry of role with its chunks resolved against shape, as H5DataIO / h5py keywords
+    options = role_options(policy, role)
+    if options.get('chunks') is not None:
+        options['chunks'] = resolve_chunks(options['chunks'], shape)
+    return options
+
+
+def h5_data_io(data, options):
+    # filters given by id (e.g. hdf5plugin's Blosc / Zstd) are dynamically loaded HDF5 plugins
+    return H5DataIO(data=data, allow_plugin_filters=isinstance(options.get('compression'), int), **options)
+
+
+def wrap_dataset(data, role, policy):
+    # datasets that already live in an HDF5 file (sharded planes) are linked as they are, and empty
+    # placeholders (deduplicated datasets, see nwb_dedup.py) are written as they are
+    shape = get_data_shape(data)
+    options = dataset_options(policy, role, shape)
+    if not options or isinstance(data, h5py.Dataset) or shape[0] == 0:
+        return data
+    return h5_data_io(data, options)
+
+
+def wrap_column(table, column_name, role, policy):
+    # ragged columns (e.g. pixel_mask) are wrapped in place once all rows are added
+    column = table[column_name]
+    column = getattr(column, 'target', column)
+    options = dataset_options(policy, role, (len(column.data),))
+    if not options or isinstance(column.data, h5py.Dataset):
+        return
+    column.transform(lambda data: h5_data_io(data, options))
+
+
+# ==========================================================================
+# ------------------------------ dtype policies ----------------------------
+# ==========================================================================
+# Precision contract of the presets:
+#   'float64' : everything is written as computed (float64), nothing is rounded.
+#   'compact' : traces and the corrected stack as float32 (relative error <= 6e-8, i.e. ~7
+#               significant digits, far below the shot noise of the recordings), xy shifts as
+#               float32 (sub-pixel shifts are kept to ~1e-6 px). Timestamps always stay float64.
+#   'integer_shifts' : like 'compact', but xy shifts as int16; only valid for whole-pixel shifts
+#               within +-32767 px, anything else raises instead of being rounded silently.
+
+DTYPE_POLICIES = {
+    'float64': {'corrected': 'float64', 'xy_translation': 'float64', 'roi_response': 'float64'},
+    'compact': {'corrected': 'float32', 'xy_translation': 'float32', 'roi_response': 'float32'},
+    'integer_shifts': {'corrected': 'float32', 'xy_translation': 'int16', 'roi_response': 'float32'},
+}
+
+
+def resolve_dtype_policy(policy):
+    if policy is None:
+        return DTYPE_POLICIES['float64']
+    if isinstance(policy, str):
+        if policy not in DTYPE_POLICIES:
+            raise ValueError(f'Unknown dtype policy {policy!r}, choose one of {sorted(DTYPE_POLICIES)}')
+        return DTYPE_POLICIES[policy]
+    return policy
+
+
+def dataset_dtype(policy, role):
+    return np.dtype(resolve_dtype_policy(policy).get(role, 'float64'))
+
+
+def cast_dataset(data, role, policy):
+    # returns data itself when it already has the policy dtype and is contiguous, a single copy otherwise
+    dtype = dataset_dtype(policy, role)
+    if isinstance(data, h5py.Dataset) and data.dtype == dtype:
+        # already cast when its file was written, reading it back would load the whole dataset
+        return data
+    data = np.asarray(data)
+    if np.issubdtype(dtype, np.integer) and not np.issubdtype(data.dtype, np.integer):
+        info = np.iinfo(dtype)
+        if not np.all(np.isfinite(data)) or np.any(np.round(data) != data) \
+                or data.min(initial=0) < info.min or data.max(initial=0) > info.max:
+            raise ValueError(f"'{role}' data cannot be stored as {dtype} without rounding or overflow")
+    return np.ascontiguousarray(data, dtype=dtype)
@@ -0,0 +1,231 @@
+import functools
+import hashlib
+import importlib
+import json
+import os
+import shutil
+
+import h5py
+import numpy as np
+
+from scan_utils import scan_cache_key
+
+
+# ==========================================================================
+# --------------------- Incremental (per-plane) updates --------------------
+# ==========================================================================
+# Every plane written by export_to_nwb stores a hash of its inputs as an attribute of its ImagingPlane
+# group: the plane key, source scan path/size/mtime, the export options that shape its datasets, the
+# content of its segmentation and timing inputs (masks, ROI ids, per-ROI timestamp offsets) and the
+# source of the modules that compute its datasets. An update re-exports only the planes whose hash
+# changed or is missing. HDF5 does not reuse the space of the replaced planes, so the file is
+# repacked once that space passes a share of the file (repack_threshold), not after every update.
+
+PLANE_HASH_ATTR = 'export_input_hash'
+
+# temporary group of repack_file
+REPACK_GROUP = '_repack'
+
+# HDF5 locations of everything export_to_nwb writes for one plane
+PLANE_CONTAINER_PATHS = ('general/optophysiology/ImagingPlane_{center_plane}',
+                         'acquisition/TwoPhotonSeries2_{center_plane}',
+                         'processing/ophys/MotionCorrection/CorrectedImageStack_{center_plane}',
+                         'processing/ophys/ImageSegmentation/PlaneSegmentation_{center_plane}',
+                         'processing/ophys/Fluorescence/RawfluorescenceResponseSeries_{center_plane}',
+                         'processing/ophys/Fluorescence/NeuropilCorrectedResponseSeries_{center_plane}',
+                         'processing/ophys/DfOverF/DfOverFResponseSeries_{center_plane}',
+                         'processing/ophys/SummaryImages_{center_plane}',
+                         'scratch/codec_selection_{center_plane}')
+
+
+@functools.lru_cache(maxsize=None)
+def code_version(module_names):
+    # hash of the source files of the modules, any edit to them rebuilds every plane
+    digest = hashlib.sha1()
+    for name in module_names:
+        source_fp = getattr(importlib.import_module(name), '__file__', None)
+        if source_fp:
+            with open(source_fp, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def plane_input_hash(plane, scan, export_options, inputs=None, code_modules=()):
+    # inputs: {name: array or value} the plane is computed from, hashed by content
+    # callables (e.g. frame providers) are identified by their qualified name
+    def default(value):
+        return getattr(value, '__qualname__', repr(value))
+
+    digest = hashlib.sha1(json.dumps({'plane': plane,
+                                      'scan': [scan_cache_key(filename) for filename in scan.filenames],
+                                      'options': export_options,
+                                      'code': code_version(tuple(code_modules))},
+                                     sort_keys=True, default=default).encode())
+    for name, value in sorted((inputs or {}).items()):
+        value = np.ascontiguousarray(value)
+        digest.update(json.dumps([name, value.dtype.str, value.shape]).encode())
+        digest.update(memoryview(value.reshape(-1)).cast('B'))
+    return digest.hexdigest()
+
+
+def read_plane_hashes(output_fp):
+    hashes = {}
+    with h5py.File(output_fp, 'r') as f:
+        for name, group in f.get('general/optophysiology', {}).items():
+            if PLANE_HASH_ATTR in group.attrs and name.startswith('ImagingPlane_'):
+                hashes[int(name[len('ImagingPlane_'):])] = group.attrs[PLANE_HASH_ATTR]
+    return hashes
+
+
+def write_plane_hashes(output_fp, hashes):
+    with h5py.File(output_fp, 'r+') as f:
+        for center_plane, plane_hash in hashes.items():
+            f[f'general/optophysiology/ImagingPlane_{center_plane}'].attrs[PLANE_HASH_ATTR] = plane_hash
+
+
+def soft_links(group, prefix=''):
+    # (path, target) of every soft link below group
+    for name in group:
+        path = f'{prefix}/{name}'
+        link = group.get(name, getlink=True)
+        if isinstance(link, h5py.SoftLink):
+            yield path, link.path
+        elif isinstance(link, h5py.HardLink) and isinstance(group[name], h5py.Group):
+            yield from soft_links(group[name], path)
+
+
+def remove_planes(output_fp, center_planes):
+    # the space of removed datasets is only freed by repack_file; objects of a removed plane that
+    # other planes still link to (e.g. a shared OpticalChannel) would leave the file unreadable
+    with h5py.File(output_fp, 'r+') as f:
+        paths = ['/' + path.format(center_plane=center_plane)
+                 for center_plane in center_planes for path in PLANE_CONTAINER_PATHS]
+        paths = [path for path in paths if path in f]
+
+        def removed(path):
+            return any(path == root or path.startswith(root + '/') for root in paths)
+
+        shared = [(path, target) for path, target in soft_links(f) if removed(target) and not removed(path)]
+        if shared:
+            raise ValueError(f'Cannot remove planes {sorted(center_planes)}, other objects link into them: {shared}')
+        for path in paths:
+            del f[path]
+        return paths
+
+
+def wasted_bytes(nwb_fp):
+    # bytes of the file not held by any dataset: space of removed objects, plus the (small) metadata
+    with h5py.File(nwb_fp, 'r') as f:
+        datasets = []
+        # visits every object once, hard links (dedup) included, and does not follow external links
+        f.visititems(lambda name, obj: datasets.append(obj) if isinstance(obj, h5py.Dataset) else None)
+        stored = sum(dset.id.get_storage_size() for dset in datasets if not dset.is_virtual)
+    return max(os.path.getsize(nwb_fp) - stored, 0)
+
+
+def needs_repack(nwb_fp, repack_threshold):
+    # repack_threshold: share of the file that may be wasted before it is repacked, None never repacks
+    return repack_threshold is not None and wasted_bytes(nwb_fp) > repack_threshold * os.path.getsize(nwb_fp)
+
+
+def repack_file(nwb_fp):
+    # HDF5 never frees the space of deleted objects: the whole tree is copied into a new file in one
+    # H5Ocopy, which keeps hard links (dedup) as one copy and remaps object references, then swapped in
+    repacked_fp = nwb_fp.with_name(nwb_fp.name + '.repack')
+    with h5py.File(nwb_fp, 'r') as src, h5py.File(repacked_fp, 'w', libver=src.libver) as dst:
+        src.copy(src['/'], dst, name=REPACK_GROUP, expand_refs=True)
+        # referenced objects also get a '~obj_pointed_by_<address>' link at the root, the same
+        # objects as their copies in the tree
+        for name in [name for name in dst if name != REPACK_GROUP]:
+            del dst[name]
+        for name in list(dst[REPACK_GROUP]):
+            dst.move(f'{REPACK_GROUP}/{name}', name)
+        dst.attrs.update(dst[REPACK_GROUP].attrs)
+        del dst[REPACK_GROUP]
+    os.replace(repacked_fp, nwb_fp)
+
+
+# ==========================================================================
+# ------------------ Atomic publication and plane checkpoints --------------
+# ==========================================================================
+# Exports are written to <file>.partial and renamed into place once complete, so a file at the
+# final path is always whole. With checkpoints, the partial file is first written without planes
+# and marked, then every plane is appended followed by its hash; a restarted export keeps the
+# planes whose hash matches and appends the rest. Updates of a single-file export are applied in
+# place (a copy would cost the whole file) between begin_update and end_update: a file still marked
+# (or unreadable) after a crash is not trusted and is exported again from scratch.
+
+PARTIAL_SUFFIX = '.partial'
+CHECKPOINT_ATTR = 'export_checkpoint'
+UPDATE_ATTR = 'export_update_in_progress'
+
+
+def partial_path(output_fp):
+    return output_fp.with_name(output_fp.name + PARTIAL_SUFFIX)
+
+
+def mark_checkpoint(partial_fp):
+    with h5py.File(partial_fp, 'r+') as f:
+        f.attrs[CHECKPOINT_ATTR] = True
+
+
+def completed_planes(partial_fp, plane_hashes):
+    # None when the partial file cannot be resumed (unreadable, or the crash hit before it was marked)
+    try:
+        with h5py.File(partial_fp, 'r') as f:
+            if not f.attrs.get(CHECKPOINT_ATTR, False):
+                return None
+        stored_hashes = read_plane_hashes(partial_fp)
+    except OSError:
+        return None
+    return {center_plane for center_plane, plane_hash in plane_hashes.items()
+            if stored_hashes.get(center_plane) == plane_hash}
+
+
+def begin_update(nwb_fp):
+    with h5py.File(nwb_fp, 'r+') as f:
+        f.attrs[UPDATE_ATTR] = True
+
+
+def end_update(nwb_fp):
+    with h5py.File(nwb_fp, 'r+') as f:
+        del f.attrs[UPDATE_ATTR]
+
+
+def update_interrupted(nwb_fp):
+    # True when an in-place update of the file did not finish
+    try:
+        with h5py.File(nwb_fp, 'r') as f:
+            return bool(f.attrs.get(UPDATE_ATTR, False))
+    except OSError:
+        return True
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def publish_file(partial_fp, output_fp, sync_fps=()):
+    # flush the data before the rename, then the directory entry, so a crash leaves either no file
+    # or the complete one at output_fp. sync_fps: files the partial file links to (e.g. the plane
+    # shards), flushed first so the published file never links to data that is not on disk
+    for fp in sync_fps:
+        fsync_path(fp)
+    fsync_path(partial_fp)
+    if partial_fp.is_dir() and output_fp.exists():
+        # directory stores (Zarr) cannot replace a non-empty directory, the old store goes first
+        shutil.rmtree(output_fp)
+    os.replace(partial_fp, output_fp)
+    try:
+        fd = os.open(output_fp.parent, os.O_RDONLY)
+    except OSError:
+        # directories cannot be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
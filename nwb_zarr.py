@@ -0,0 +1,330 @@
+import argparse
+import json
+import multiprocessing
+import os
+import pathlib
+import sys
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+from hdmf.container import Data
+from hdmf.data_utils import GenericDataChunkIterator
+from pynwb import NWBHDF5IO
+
+from nwb_storage import dataset_options, resolve_chunks
+
+try:
+    import numcodecs
+    import zarr
+    from hdmf_zarr import ZarrDataIO
+    from hdmf_zarr.nwb import NWBZarrIO
+except ImportError:
+    # the Zarr backend is only available when hdmf-zarr is installed
+    zarr = None
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+# ==========================================================================
+# ----------------------------- Zarr backend -------------------------------
+# ==========================================================================
+# With backend='zarr', export_to_nwb writes NWB-on-Zarr to a local directory store
+# (<file>.nwb.zarr) through hdmf-zarr. A directory store keeps every chunk in its own file, so
+# the chunks of one dataset can be encoded and written by many processes at once: the corrected
+# and raw stacks (ScanFrameIterator) and the large in-memory arrays (traces, placeholder stacks)
+# are split into buffers of whole chunks and written by write_workers processes. The workers are
+# forked, so they read the in-memory arrays of the exporting process itself (copy-on-write pages
+# that are only read); where processes cannot be forked, each array is copied once to a
+# memory-mapped file that the workers open by path, which holds its size again until it is released. Smaller datasets, and the compound
+# pixel_mask column, are written by the main process.
+# The storage policy's HDF5 codecs map onto numcodecs codecs that produce the same chunk bytes:
+# gzip -> Zlib and shuffle -> Shuffle, Zstd / Blosc (hdf5plugin) -> Zstd / Blosc. numcodecs has no
+# LZF, so lzf is written as Blosc lz4.
+# zarr_to_nwb converts a Zarr export back to one HDF5 NWB file for archival. hdmf writes the
+# structure, and the large datasets are then filled by copying their encoded chunk files straight
+# into HDF5 chunks, without decoding or re-encoding them.
+
+ZARR_SUFFIX = '.nwb.zarr'
+
+# in-memory arrays from this size on go through the parallel writer
+SHARED_ARRAY_MIN_BYTES = 2**20
+# target bytes of the chunks of in-memory arrays when the storage policy leaves them open
+ZARR_CHUNK_BYTES = 4 * 2**20
+# bytes of the buffers handed to one worker at a time
+ZARR_BUFFER_BYTES = 32 * 2**20
+
+# forked workers share the arrays of the exporting process, else they are copied to SHARED_ARRAY_DIR
+FORK_WORKERS = 'fork' in multiprocessing.get_all_start_methods()
+# in-memory arrays of this process by key, inherited by the forked workers
+SHARED_ARRAYS = {}
+
+# memory-backed when available, the workers only read pages they write
+SHARED_ARRAY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+ZSTD_FILTER_ID = 32015
+BLOSC_FILTER_ID = 32001
+BLOSC_CNAMES = ('blosclz', 'lz4', 'lz4hc', 'snappy', 'zlib', 'zstd')
+
+
+def require_zarr():
+    if zarr is None:
+        raise ImportError("backend='zarr' needs hdmf-zarr (pip install hdmf-zarr)")
+
+
+def store_bytes(path):
+    # size of a file, or of every file of a directory store
+    path = pathlib.Path(path)
+    if not path.is_dir():
+        return path.stat().st_size
+    return sum(entry.stat().st_size for entry in path.rglob('*') if entry.is_file())
+
+
+# ----- Codecs -----
+
+def zarr_codecs(options, itemsize):
+    # (compressor, filters) writing the chunk bytes the HDF5 options would write
+    compression = options.get('compression')
+    filters = [numcodecs.Shuffle(elementsize=itemsize)] if options.get('shuffle') else None
+    opts = options.get('compression_opts')
+    if compression is None:
+        return None, filters
+    if compression == 'gzip':
+        return numcodecs.Zlib(level=4 if opts is None else opts), filters
+    if compression == 'lzf':
+        return numcodecs.Blosc(cname='lz4', clevel=5, shuffle=numcodecs.Blosc.NOSHUFFLE), filters
+    if compression == ZSTD_FILTER_ID:
+        return numcodecs.Zstd(level=opts[0] if opts else 3), filters
+    if compression == BLOSC_FILTER_ID:
+        return numcodecs.Blosc(cname=BLOSC_CNAMES[opts[6]], clevel=opts[4], shuffle=opts[5]), filters
+    raise ValueError(f'No Zarr codec for HDF5 compression {compression!r}')
+
+
+def hdf5_codec(array):
+    # (HDF5 options, direct): direct when the Zarr chunk bytes are valid HDF5 chunks for these options
+    filters = array.filters or []
+    shuffle = len(filters) == 1 and isinstance(filters[0], numcodecs.Shuffle) \
+        and filters[0].elementsize == array.dtype.itemsize
+    compressor = array.compressor
+    if filters and not shuffle:
+        options = None
+    elif compressor is None:
+        options = {}
+    elif isinstance(compressor, numcodecs.Zlib):
+        options = dict(compression='gzip', compression_opts=compressor.level)
+    elif isinstance(compressor, numcodecs.Zstd) and hdf5plugin:
+        options = dict(hdf5plugin.Zstd(clevel=compressor.level))
+    elif isinstance(compressor, numcodecs.Blosc) and hdf5plugin:
+        options = dict(hdf5plugin.Blosc(cname=compressor.cname, clevel=compressor.clevel,
+                                        shuffle=compressor.shuffle))
+    else:
+        options = None
+    if options is None:
+        # decoded and written again
+        return dict(compression='gzip', compression_opts=4, shuffle=True), False
+    if shuffle:
+        options['shuffle'] = True
+    return options, True
+
+
+# ----- Writing -----
+
+class SharedArrayIterator(GenericDataChunkIterator):
+    """An in-memory array written by the hdmf-zarr worker processes.
+
+    Forked workers receive the key of the array in SHARED_ARRAYS and read it from the memory they
+    inherited. Otherwise the array is copied once to a memory-mapped .npy file whose path the workers
+    receive. Either way they read only the buffers they write; release() drops the array (and removes
+    the file) once the store is written.
+    """
+
+    def __init__(self, path=None, chunk_shape=None, buffer_shape=None, key=None):
+        self.path = None if path is None else str(path)
+        self.key = key
+        self.array = SHARED_ARRAYS[key] if key is not None else np.load(self.path, mmap_mode='r')
+        length = max(len(self.array), 1)
+        row_bytes = max(self.array.nbytes // length, 1)
+        if chunk_shape is None:
+            # whole rows of the first axis, a partial last chunk then wastes at most one row of chunks
+            chunk_shape = (min(max(1, ZARR_CHUNK_BYTES // row_bytes), length),) + self.array.shape[1:]
+        if buffer_shape is None:
+            # whole chunk rows, ZARR_BUFFER_BYTES at a time
+            rows = max(chunk_shape[0], ZARR_BUFFER_BYTES // row_bytes // chunk_shape[0] * chunk_shape[0])
+            buffer_shape = (min(rows, length),) + self.array.shape[1:]
+        super().__init__(chunk_shape=tuple(chunk_shape), buffer_shape=tuple(buffer_shape), display_progress=False)
+
+    @classmethod
+    def from_array(cls, array, chunk_shape=None):
+        if FORK_WORKERS:
+            key = uuid.uuid4().hex
+            SHARED_ARRAYS[key] = array
+            return cls(key=key, chunk_shape=chunk_shape)
+        path = pathlib.Path(SHARED_ARRAY_DIR) / f'nwb_zarr_{uuid.uuid4().hex}.npy'
+        np.save(path, np.ascontiguousarray(array))
+        return cls(path, chunk_shape=chunk_shape)
+
+    def _to_dict(self):
+        return {'path': self.path, 'key': self.key, 'chunk_shape': self.chunk_shape,
+                'buffer_shape': self.buffer_shape}
+
+    @staticmethod
+    def _from_dict(dictionary):
+        return SharedArrayIterator(**dictionary)
+
+    def _get_data(self, selection):
+        return np.asarray(self.array[selection])
+
+    def _get_maxshape(self):
+        return self.array.shape
+
+    def _get_dtype(self):
+        return self.array.dtype
+
+    def release(self):
+        self.array = None
+        if self.key is not None:
+            SHARED_ARRAYS.pop(self.key, None)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def zarr_data_io(data, role, policy, shared_arrays=None):
+    # counterpart of nwb_storage.wrap_dataset: codecs and chunks of the policy, large arrays made
+    # writable by the worker processes (appended to shared_arrays, see release_shared_arrays)
+    shape = data.maxshape if isinstance(data, GenericDataChunkIterator) else np.shape(data)
+    options = dataset_options(policy, role, shape)
+    dtype = data.dtype if isinstance(data, GenericDataChunkIterator) else np.asarray(data).dtype
+    compressor, filters = zarr_codecs(options, dtype.itemsize)
+    chunks = options.get('chunks')
+    if isinstance(data, GenericDataChunkIterator):
+        # the workers write whole buffers, which are whole chunks of the iterator only
+        chunks = data.chunk_shape
+    elif isinstance(data, np.ndarray) and data.nbytes >= SHARED_ARRAY_MIN_BYTES and shared_arrays is not None:
+        data = SharedArrayIterator.from_array(data, chunk_shape=chunks)
+        chunks = data.chunk_shape
+        shared_arrays.append(data)
+    # compressor=False disables Zarr's default compressor
+    return ZarrDataIO(data=data, chunks=chunks, compressor=compressor or False, filters=filters)
+
+
+def release_shared_arrays(shared_arrays):
+    while shared_arrays:
+        shared_arrays.pop().release()
+
+
+def shared_copy_bytes(array_bytes):
+    # memory the copies of in-memory arrays of these sizes hold while a store is written
+    if FORK_WORKERS:
+        return 0
+    return sum(nbytes for nbytes in array_bytes if nbytes >= SHARED_ARRAY_MIN_BYTES)
+
+
+def write_zarr(nwbfile, path, workers=None):
+    # buffers of the parallel datasets are spread over worker processes, the rest is written here
+    require_zarr()
+    with NWBZarrIO(str(path), mode='w') as io:
+        io.write(nwbfile, number_of_jobs=workers or os.cpu_count(),
+                 multiprocessing_context='fork' if FORK_WORKERS else None)
+
+
+# ----- Conversion to HDF5 -----
+
+def zarr_chunk_key(array, index):
+    # metadata may be consolidated, the chunk store always holds the array's own .zarray
+    separator = json.loads(array.chunk_store[f'{array.path}/.zarray']).get('dimension_separator') or '.'
+    return f'{array.path}/' + separator.join(str(i) for i in index)
+
+
+def copy_chunks(array, dset, direct, workers=None):
+    # chunk files (or decoded chunk rows) are read by a thread pool, HDF5 writes stay in this thread
+    grid = [range(-(-size // chunk)) for size, chunk in zip(array.shape, array.chunks)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        if direct:
+            indices = [index for index in np.ndindex(*[len(axis) for axis in grid])]
+            encoded = executor.map(lambda index: array.chunk_store.get(zarr_chunk_key(array, index)), indices)
+            for index, chunk in zip(indices, encoded):
+                # chunks equal to the fill value may not exist, HDF5 reads them as the fill value too
+                if chunk is not None:
+                    dset.id.write_direct_chunk(tuple(i * c for i, c in zip(index, array.chunks)), chunk)
+        else:
+            starts = range(0, array.shape[0], array.chunks[0])
+            for start, block in zip(starts, executor.map(lambda start: array[start:start + array.chunks[0]], starts)):
+                dset[start:start + len(block)] = block
+
+
+def compound_records(array):
+    # hdmf-zarr stores compound rows as (rows, fields) of the compound dtype, field i in column i
+    records = np.empty(array.shape[0], dtype=array.dtype)
+    values = array[:]
+    for i, name in enumerate(array.dtype.names):
+        records[name] = values[:, i][name]
+    return records
+
+
+def set_field(container, name, value):
+    if isinstance(container, Data):
+        container.transform(lambda _: value)
+    else:
+        container.fields[name] = value
+
+
+def zarr_to_nwb(zarr_fp, nwb_fp=None, workers=None, min_bytes=SHARED_ARRAY_MIN_BYTES):
+    """Convert a Zarr NWB export to an HDF5 NWB file (default: the same name with .nwb).
+
+    Datasets of at least min_bytes keep their chunks and codecs; their encoded chunks are copied as
+    they are unless the codec has no HDF5 equivalent here (then they are decoded and gzip-compressed).
+    """
+    require_zarr()
+    zarr_fp = pathlib.Path(zarr_fp)
+    nwb_fp = pathlib.Path(nwb_fp) if nwb_fp else zarr_fp.with_name(zarr_fp.name[:-len(ZARR_SUFFIX)] + '.nwb')
+    deferred = {}
+    with NWBZarrIO(str(zarr_fp), mode='r') as zarr_io:
+        nwbfile = zarr_io.read()
+        # large datasets are exported as empty placeholders and filled below
+        for container in nwbfile.objects.values():
+            if isinstance(container, Data):
+                fields = {'data': container.data}
+            else:
+                fields = container.fields
+            for name, value in list(fields.items()):
+                if isinstance(value, zarr.Array) and value.dtype.names and value.ndim == 2:
+                    set_field(container, name, compound_records(value))
+                    continue
+                if not isinstance(value, zarr.Array) or value.nbytes < min_bytes \
+                        or value.dtype.kind not in 'biuf' or value.ndim == 0:
+                    continue
+                deferred[value.path] = value
+                set_field(container, name, np.empty((0,) + value.shape[1:], dtype=value.dtype))
+        with NWBHDF5IO(str(nwb_fp), mode='w') as io:
+            io.export(src_io=zarr_io, nwbfile=nwbfile, write_args={'link_data': False})
+        with h5py.File(nwb_fp, 'r+') as f:
+            for path, array in deferred.items():
+                attrs = dict(f[path].attrs)
+                del f[path]
+                options, direct = hdf5_codec(array)
+                dset = f.create_dataset(path, shape=array.shape, dtype=array.dtype,
+                                        chunks=resolve_chunks(array.chunks, array.shape),
+                                        fillvalue=array.fill_value, **options)
+                dset.attrs.update(attrs)
+                copy_chunks(array, dset, direct, workers)
+    print(f'\tConverted {zarr_fp.name} to {nwb_fp.name} ({len(deferred)} datasets copied chunk by chunk)')
+    return nwb_fp
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert a Zarr NWB export to an HDF5 NWB file')
+    parser.add_argument('zarr_fp')
+    parser.add_argument('nwb_fp', nargs='?')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+    zarr_to_nwb(args.zarr_fp, args.nwb_fp, workers=args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
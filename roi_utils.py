@@ -0,0 +1,87 @@
+import numpy as np
+from hdmf.common.table import ElementIdentifiers, VectorData, VectorIndex
+
+
+# ==========================================================================
+# ------------------------- Bulk ROI (pixel mask) ingestion ----------------
+# ==========================================================================
+
+# on-disk layout of the PlaneSegmentation pixel_mask column
+PIXEL_MASK_DTYPE = np.dtype([('x', '<u4'), ('y', '<u4'), ('weight', '<f4')])
+
+
+def pixel_mask_array(x, y, weight):
+    masks = np.empty(len(x), dtype=PIXEL_MASK_DTYPE)
+    masks['x'] = x
+    masks['y'] = y
+    masks['weight'] = weight
+    return masks
+
+
+def pixel_mask_columns(masks, offsets, ids=None):
+    # masks hold the pixels of all ROIs back to back (PIXEL_MASK_DTYPE), ROI i owns masks[offsets[i]:offsets[i + 1]]
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if offsets[0] != 0 or offsets[-1] != len(masks) or np.any(np.diff(offsets) < 0):
+        raise ValueError('offsets must start at 0, end at the number of pixels and be non-decreasing')
+    num_rois = len(offsets) - 1
+    pixel_mask = VectorData(name='pixel_mask',
+                            description='Pixel masks for each ROI',
+                            data=masks)
+    pixel_mask_index = VectorIndex(name='pixel_mask_index', data=offsets[1:], target=pixel_mask)
+    ids = ElementIdentifiers(name='id', data=np.arange(num_rois) if ids is None else np.asarray(ids))
+    return [pixel_mask, pixel_mask_index], ids
+
+
+def create_plane_segmentation_bulk(img_seg, masks, offsets, ids=None, **kwargs):
+    # columnar replacement for one ps.add_roi(pixel_mask=list(zip(...))) call per ROI: the ragged
+    # pixel_mask / pixel_mask_index columns are handed to the table as whole arrays
+    columns, ids = pixel_mask_columns(masks, offsets, ids=ids)
+    return img_seg.create_plane_segmentation(columns=columns, id=ids, **kwargs)
+
+
+# ==========================================================================
+# ------------------------- Compact per-ROI timestamps ---------------------
+# ==========================================================================
+# ROIs are sampled when the scanner passes over them, so every ROI has its own sample times.
+# Instead of a (frames, rois) timestamp matrix, a RoiResponseSeries stores one shared frame-time
+# vector and the PlaneSegmentation stores a 'timestamp_offset' column: the seconds between the
+# start of the plane's frame and the line at the ROI's centroid.
+
+def roi_centroids(y, weight, offsets):
+    roi_index = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    total_weight = np.bincount(roi_index, weights=weight, minlength=len(offsets) - 1)
+    return np.bincount(roi_index, weights=weight * y, minlength=len(offsets) - 1) / total_weight
+
+
+def seconds_per_line(scan, field=0):
+    # fall back to evenly spread lines when the scan header has no line period
+    line_period = getattr(scan, 'seconds_per_line', None)
+    if line_period:
+        return line_period
+    return 1. / (scan.fps * scan.num_scanning_depths * scan.field_heights[field])
+
+
+def frame_times(scan, field, num_frames):
+    # start time of each frame of this field; fields of a volume are scanned one after the other
+    return (np.arange(num_frames) + field / scan.num_scanning_depths) / scan.fps
+
+
+def roi_time_offsets(scan, field, y_centroids):
+    return np.asarray(y_centroids, dtype=np.float64) * seconds_per_line(scan, field)
+
+
+def add_timestamp_offsets(plane_segmentation, offsets):
+    plane_segmentation.add_column(name='timestamp_offset',
+                                  description='seconds between the RoiResponseSeries timestamps and the time '
+                                              'the scanner sampled this ROI',
+                                  data=np.asarray(offsets, dtype=np.float64))
+
+
+def roi_timestamps(roi_response_series, rois=None):
+    # per-ROI sample times of a series, shape (frames,) for one ROI or (frames, len(rois)) for several;
+    # rois index the columns of the series, None means all of them
+    table_rows = np.asarray(roi_response_series.rois.data[:])
+    table_rows = table_rows if rois is None else table_rows[rois]
+    offsets = np.asarray(roi_response_series.rois.table['timestamp_offset'].data[:])[table_rows]
+    timestamps = np.asarray(roi_response_series.timestamps[:])
+    return timestamps[:, None] + offsets if np.ndim(offsets) else timestamps + offsets
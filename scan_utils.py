@@ -0,0 +1,271 @@
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+import tempfile
+import threading
+
+import numpy as np
+import scanreader
+from hdmf.data_utils import GenericDataChunkIterator
+
+
+# ==========================================================================
+# ------------------------- Frame access helpers ---------------------------
+# ==========================================================================
+
+def plane_field(plane, scan):
+    # single-depth tiffs hold one plane each, multi-depth tiffs hold one field per center_plane
+    return plane['center_plane'] if scan.num_scanning_depths > 1 else 0
+
+
+def read_frame_block(scan, field, start, stop, channel=0):
+    # scanreader indexes as [field, y, x, channel, frame]; NWB ImageSeries are frame-first
+    block = scan[field, :, :, channel, start:stop]
+    return np.moveaxis(block, -1, 0)
+
+
+def iter_frame_blocks(scan, field=0, block_size=100, start=0, stop=None, frame_provider=None):
+    frame_provider = frame_provider or read_frame_block
+    stop = scan.num_frames if stop is None else stop
+    for block_start in range(start, stop, block_size):
+        yield frame_provider(scan, field, block_start, min(block_start + block_size, stop))
+
+
+class ScanFrameIterator(GenericDataChunkIterator):
+    """Stream the frames of one scan field to the NWB writer, block_size frames at a time.
+
+    frame_provider(scan, field, start, stop) may replace the raw scanreader read, e.g. to
+    hand over motion-corrected frames; it must return an array of shape (stop - start, height, width).
+    """
+
+    def __init__(self, scan, field=0, block_size=100, frame_provider=None, dtype=None, chunk_shape=None):
+        self.scan = scan
+        self.field = field
+        self.block_size = block_size
+        self.frame_provider = frame_provider or read_frame_block
+        self.frame_dtype = np.dtype(dtype or self.frame_provider(scan, field, 0, 1).dtype)
+        height, width = scan.field_heights[field], scan.field_widths[field]
+        block_size = min(block_size, scan.num_frames)
+        chunk_shape = chunk_shape or (1, height, width)
+        # the writer requires whole chunks per buffer
+        block_size = max(chunk_shape[0], block_size - block_size % chunk_shape[0])
+        super().__init__(buffer_shape=(block_size, height, width), chunk_shape=tuple(chunk_shape))
+
+    def _to_dict(self):
+        # pickling support, e.g. for the worker processes of the Zarr backend (nwb_zarr.py); raises for
+        # frame providers that cannot be pickled (lambdas, closures), which are then written serially
+        pickle.dumps(self.frame_provider)
+        return {'scan': self.scan, 'field': self.field, 'block_size': self.block_size,
+                'frame_provider': self.frame_provider, 'dtype': self.frame_dtype, 'chunk_shape': self.chunk_shape}
+
+    @staticmethod
+    def _from_dict(dictionary):
+        return ScanFrameIterator(**dictionary)
+
+    def _get_data(self, selection):
+        frames = self.frame_provider(self.scan, self.field, selection[0].start, selection[0].stop)
+        return np.asarray(frames, dtype=self.frame_dtype)[(slice(None),) + tuple(selection[1:])]
+
+    def _get_maxshape(self):
+        return self.scan.num_frames, self.scan.field_heights[self.field], self.scan.field_widths[self.field]
+
+    def _get_dtype(self):
+        return self.frame_dtype
+
+
+class PageFrameReader:
+    """frame_provider that reads the tiff pages of a scan directly, one page at a time.
+
+    Pages are interleaved as frame > depth > channel, so a plane of a multi-depth scan is every
+    num_scanning_depths-th group of pages. Each page is read straight into the output block, so
+    memory stays at one block of frames whatever the size of the tiffs. The files of a block are
+    opened for that block only, no file handle outlives a read.
+    """
+
+    def __init__(self, scan):
+        self.page_offsets = scan.page_offsets
+        self.page_dtype = np.dtype(scan.page_dtype)
+        self.page_shape = tuple(scan.page_shape)
+        # global page index -> (file, page in file)
+        self.file_starts = np.cumsum([0] + [len(offsets) for offsets in self.page_offsets])
+
+    def read_page(self, scan, page, out, files):
+        file_index = int(np.searchsorted(self.file_starts, page, side='right')) - 1
+        if file_index not in files:
+            files[file_index] = open(scan.filenames[file_index], 'rb', buffering=0)
+        f = files[file_index]
+        f.seek(self.page_offsets[file_index][page - self.file_starts[file_index]])
+        f.readinto(memoryview(out).cast('B'))
+
+    def __call__(self, scan, field, start, stop, channel=0):
+        pages_per_frame = scan.num_scanning_depths * scan.num_channels
+        block = np.empty((stop - start,) + self.page_shape, dtype=self.page_dtype)
+        files = {}
+        try:
+            for i, frame in enumerate(range(start, stop)):
+                self.read_page(scan, frame * pages_per_frame + field * scan.num_channels + channel, block[i],
+                               files)
+        finally:
+            for f in files.values():
+                f.close()
+        return block
+
+
+def raw_frame_provider(scan, field=0):
+    # direct page reads when the tiff layout allows them and a page is exactly one field, scanreader
+    # reads otherwise (compressed tiffs, multi-ROI scans with several fields per page)
+    page_shape = getattr(scan, 'page_shape', None)
+    if getattr(scan, 'page_offsets', None) and page_shape \
+            and tuple(page_shape) == (scan.field_heights[field], scan.field_widths[field]) \
+            and scan.num_fields == scan.num_scanning_depths:
+        return PageFrameReader(scan)
+    return read_frame_block
+
+
+# ==========================================================================
+# ------------------ Lazy scans and scan metadata cache --------------------
+# ==========================================================================
+
+# a directory with one JSON file per scan, so a cache miss reads and writes only its own entry
+SCAN_METADATA_CACHE = os.environ.get('SCAN_METADATA_CACHE',
+                                     os.path.join(os.path.expanduser('~'), '.cache', 'scan_metadata'))
+SCAN_METADATA_FIELDS = ('fps', 'num_scanning_depths', 'num_fields', 'num_channels', 'num_frames',
+                        'field_heights', 'field_widths', 'filenames')
+# entries derived on a cache miss, possibly None when the scan cannot provide them
+SCAN_METADATA_EXTRAS = ('seconds_per_line', 'page_offsets', 'page_dtype', 'page_shape')
+
+
+def scan_cache_key(path):
+    # a rewritten tiff changes size or mtime and therefore misses the cache
+    stat = os.stat(path)
+    return f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def scan_cache_entry(key, cache_dir=SCAN_METADATA_CACHE):
+    return pathlib.Path(cache_dir) / (hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+
+def load_scan_metadata(key, cache_dir=SCAN_METADATA_CACHE):
+    # None on a miss; the key is stored in the entry as well, in case of a hash collision
+    try:
+        with open(scan_cache_entry(key, cache_dir)) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return entry['metadata'] if entry.get('key') == key else None
+
+
+def store_scan_metadata(key, metadata, cache_dir=SCAN_METADATA_CACHE):
+    # written to a temporary file and renamed, concurrent writers of the same entry write the same content
+    entry_fp = scan_cache_entry(key, cache_dir)
+    entry_fp.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=entry_fp.parent, suffix='.tmp', delete=False) as f:
+        json.dump({'key': key, 'metadata': metadata}, f)
+    os.replace(f.name, entry_fp)
+
+
+def read_page_layout(filenames):
+    # page offsets, dtype and shape for direct (memory-mapped) page reads; all None unless every page
+    # is uncompressed, stored contiguously and of the same shape and dtype
+    import tifffile
+    offsets, layouts = [], set()
+    for filename in filenames:
+        with tifffile.TiffFile(filename) as tif:
+            file_offsets = []
+            for page in tif.pages:
+                if page.compression != 1 or not page.is_contiguous:
+                    return {'page_offsets': None, 'page_dtype': None, 'page_shape': None}
+                file_offsets.append(page.dataoffsets[0])
+                layouts.add((tif.byteorder + page.dtype.char, page.shape))
+            offsets.append(file_offsets)
+    if len(layouts) != 1:
+        return {'page_offsets': None, 'page_dtype': None, 'page_shape': None}
+    page_dtype, page_shape = layouts.pop()
+    return {'page_offsets': offsets, 'page_dtype': page_dtype, 'page_shape': list(page_shape)}
+
+
+def scan_metadata(scan):
+    metadata = {name: getattr(scan, name) for name in SCAN_METADATA_FIELDS}
+    metadata['fps'] = float(metadata['fps'])
+    for name in ('num_scanning_depths', 'num_fields', 'num_channels', 'num_frames'):
+        metadata[name] = int(metadata[name])
+    for name in ('field_heights', 'field_widths'):
+        metadata[name] = [int(size) for size in metadata[name]]
+    metadata['filenames'] = list(metadata['filenames'])
+    # not every scan header has a line period
+    line_period = getattr(scan, 'seconds_per_line', None)
+    metadata['seconds_per_line'] = float(line_period) if line_period else None
+    try:
+        metadata.update(read_page_layout(metadata['filenames']))
+    except Exception:
+        # the layout only enables direct page reads, a scan is still usable without it
+        metadata.update(page_offsets=None, page_dtype=None, page_shape=None)
+    return metadata
+
+
+# scans opened in this process and their metadata, shared by every LazyScan of the same path, size and
+# mtime, so a tiff listed several times is opened and parsed once; reads of a shared scan are serialized
+_open_scans = {}
+_open_scans_lock = threading.Lock()
+_scan_metadata = {}
+
+
+def open_scan(path):
+    # (scan, lock) of the scanreader scan of path
+    key = scan_cache_key(path)
+    with _open_scans_lock:
+        if key not in _open_scans:
+            _open_scans[key] = (scanreader.read_scan(path), threading.Lock())
+        return _open_scans[key]
+
+
+class LazyScan:
+    """A scanreader scan that is only opened when frames are read.
+
+    Metadata (fps, num_scanning_depths, frame counts, page offsets, ...) is answered from an
+    on-disk cache keyed by path, size and mtime, so most attribute lookups never parse the tiff.
+    LazyScans of the same file share one open scan (see open_scan).
+    """
+
+    def __init__(self, path, cache_dir=SCAN_METADATA_CACHE):
+        self.path = path
+        self.cache_dir = cache_dir
+        self._scan = None
+        self._lock = None
+        self._metadata = None
+
+    @property
+    def scan(self):
+        if self._scan is None:
+            self._scan, self._lock = open_scan(self.path)
+        return self._scan
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            key = scan_cache_key(self.path)
+            metadata = _scan_metadata.get(key) or load_scan_metadata(key, self.cache_dir)
+            # entries written before a field was added to the cache are refreshed
+            if metadata is None or any(name not in metadata for name in SCAN_METADATA_FIELDS + SCAN_METADATA_EXTRAS):
+                metadata = scan_metadata(self.scan)
+                store_scan_metadata(key, metadata, self.cache_dir)
+            self._metadata = _scan_metadata.setdefault(key, metadata)
+        return self._metadata
+
+    def __getstate__(self):
+        # sent to worker processes unopened, each worker opens its own scan
+        return dict(self.__dict__, _scan=None, _lock=None)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in SCAN_METADATA_FIELDS or name in SCAN_METADATA_EXTRAS:
+            return self.metadata[name]
+        return getattr(self.scan, name)
+
+    def __getitem__(self, key):
+        scan = self.scan
+        with self._lock:
+            return scan[key]
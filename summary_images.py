@@ -0,0 +1,89 @@
+import numpy as np
+
+from scan_utils import iter_frame_blocks
+
+
+# ==========================================================================
+# ------------------------ Streaming summary images ------------------------
+# ==========================================================================
+# Mean, max, standard deviation and local correlation images of a plane from one pass over its
+# frames, block_size frames at a time. Only a handful of (height, width) float64 images are kept:
+# sums of the frames, of their squares and of the products with the right, lower, lower-right
+# and lower-left neighbours. Frames are shifted by the mean of the first block before summing,
+# which leaves variances and covariances unchanged and keeps the sums well conditioned.
+
+SUMMARY_IMAGES = ('mean', 'max', 'std', 'correlation')
+
+# neighbour offsets (dy, dx) whose products are summed; the other four neighbours are their mirror
+NEIGHBOUR_OFFSETS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+def neighbour_views(image, dy, dx):
+    # (pixel, neighbour) views of the pixels that have a neighbour at (dy, dx), leading axes kept
+    height, width = image.shape[-2:]
+    rows, shifted_rows = slice(0, height - dy), slice(dy, height)
+    cols = slice(0, width - dx) if dx >= 0 else slice(-dx, width)
+    shifted_cols = slice(dx, width) if dx >= 0 else slice(0, width + dx)
+    return image[..., rows, cols], image[..., shifted_rows, shifted_cols]
+
+
+class SummaryAccumulator:
+    """Running sums for the summary images of one plane, fed with (frames, height, width) blocks."""
+
+    def __init__(self, height, width):
+        self.shape = (height, width)
+        self.count = 0
+        self.shift = None
+        self.sum = np.zeros(self.shape)
+        self.sum_sq = np.zeros(self.shape)
+        self.max = np.full(self.shape, -np.inf)
+        self.sum_products = {offset: np.zeros(neighbour_views(self.sum, *offset)[0].shape)
+                             for offset in NEIGHBOUR_OFFSETS}
+
+    def add(self, block):
+        block = np.asarray(block)
+        if len(block) == 0:
+            return
+        np.maximum(self.max, block.max(axis=0), out=self.max)
+        if self.shift is None:
+            self.shift = block.mean(axis=0, dtype=np.float64)
+        centered = block - self.shift
+        self.count += len(block)
+        self.sum += centered.sum(axis=0)
+        self.sum_sq += np.einsum('fyx,fyx->yx', centered, centered)
+        for offset, sum_products in self.sum_products.items():
+            pixels, neighbours = neighbour_views(centered, *offset)
+            sum_products += np.einsum('fyx,fyx->yx', pixels, neighbours)
+
+    def images(self):
+        # float32 (height, width) images; pixels without variance have zero correlation
+        count = max(self.count, 1)
+        mean = self.sum / count
+        variance = np.maximum(self.sum_sq / count - mean ** 2, 0)
+        std = np.sqrt(variance)
+        correlation_sum = np.zeros(self.shape)
+        neighbours = np.zeros(self.shape)
+        for offset, sum_products in self.sum_products.items():
+            mean_pixel, mean_neighbour = neighbour_views(mean, *offset)
+            std_pixel, std_neighbour = neighbour_views(std, *offset)
+            denominator = std_pixel * std_neighbour
+            correlation = np.divide(sum_products / count - mean_pixel * mean_neighbour, denominator,
+                                    out=np.zeros_like(denominator), where=denominator > 0)
+            # every product counts for both pixels of the pair
+            for target in neighbour_views(correlation_sum, *offset):
+                target += correlation
+            for target in neighbour_views(neighbours, *offset):
+                target += 1
+        shift = self.shift if self.shift is not None else 0.
+        return {'mean': (mean + shift).astype(np.float32),
+                'max': self.max.astype(np.float32),
+                'std': std.astype(np.float32),
+                'correlation': (correlation_sum / np.maximum(neighbours, 1)).astype(np.float32)}
+
+
+def compute_summary_images(scan, field=0, block_size=100, frame_provider=None):
+    # one pass over the field's frames, memory bounded by one block plus the accumulator images
+    accumulator = SummaryAccumulator(scan.field_heights[field], scan.field_widths[field])
+    for block in iter_frame_blocks(scan, field=field, block_size=block_size, frame_provider=frame_provider):
+        accumulator.add(block)
+    return accumulator.images()
@@ -0,0 +1,27 @@
+import os
+import time
+
+from batch_export import run_parallel_export
+
+
+def fake_export(session_key, output_dir='./', overwrite=True):
+    # 'crash' kills its worker process the way the OOM killer would, the others take a moment
+    if session_key == 'crash':
+        time.sleep(0.2)
+        os._exit(9)
+    time.sleep(0.5)
+    return None
+
+
+def test_dead_worker_fails_only_its_session(tmp_path):
+    session_keys = ['a', 'b', 'crash', 'c', 'd']
+    results, summary = run_parallel_export(fake_export, session_keys, output_dir=tmp_path, num_workers=2)
+    statuses = {result['session_key']: result['status'] for result in results}
+    assert statuses == {'a': 'skipped', 'b': 'skipped', 'crash': 'failed', 'c': 'skipped', 'd': 'skipped'}
+    assert summary['failed'] == 1
+
+
+def test_dead_worker_alone(tmp_path):
+    results, _ = run_parallel_export(fake_export, ['crash', 'a'], output_dir=tmp_path, num_workers=1)
+    assert sorted((result['session_key'], result['status']) for result in results) == \
+        [('a', 'skipped'), ('crash', 'failed')]
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from df_over_f import BASELINE_METHODS, compute_df_over_f
+
+
+# chunked dF/F must equal the unchunked one, also when the last chunk is shorter than the
+# baseline window (24600 frames in chunks of 4096 leave a last chunk of 24 frames)
+@pytest.mark.parametrize('method', BASELINE_METHODS)
+@pytest.mark.parametrize('num_frames, window_frames', [(24600, 1800), (5000, 1800), (1000, 1800), (4100, 60)])
+def test_chunks_match_unchunked(method, num_frames, window_frames):
+    traces = (np.random.default_rng(num_frames).random((num_frames, 5)) + 1).astype(np.float32)
+    whole = compute_df_over_f(traces, window_frames, method=method, chunk_frames=num_frames)
+    chunked = compute_df_over_f(traces, window_frames, method=method, chunk_frames=4096, workers=2)
+    np.testing.assert_array_equal(chunked, whole)
+
+
+def test_non_positive_baseline_gives_zero():
+    traces = np.zeros((500, 3), dtype=np.float32)
+    assert not compute_df_over_f(traces, 100).any()
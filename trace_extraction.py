@@ -0,0 +1,111 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from scipy import ndimage, sparse
+
+from scan_utils import read_frame_block
+
+
+# ==========================================================================
+# -------------------- Fluorescence extraction (sparse) --------------------
+# ==========================================================================
+# The pixel masks of all ROIs of a plane become one (rois, height * width) sparse weight matrix,
+# each row normalized to sum to 1. Every block of frames is flattened to (height * width, frames)
+# and multiplied once by that matrix, so the cost is mask pixels x frames for all ROIs together.
+# Neuropil traces use a second matrix of rings around the ROIs (pixels of no ROI, at least
+# neuropil_gap pixels away from any ROI), and the corrected traces are
+#   F - neuropil_coefficient * F_neuropil
+# Blocks are spread over a process pool.
+
+def mask_matrix(rows, pixels, weights, num_rois, num_pixels):
+    # CSR (num_rois, num_pixels) matrix whose rows sum to 1, ROIs without weight stay empty
+    matrix = sparse.csr_matrix((np.asarray(weights, dtype=np.float32), (rows, pixels)),
+                               shape=(num_rois, num_pixels))
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    scale = np.divide(1., totals, out=np.zeros_like(totals), where=totals > 0)
+    return sparse.diags(scale.astype(np.float32)) @ matrix
+
+
+def roi_mask_matrix(masks, offsets, height, width):
+    # masks: PIXEL_MASK_DTYPE pixels of all ROIs back to back, ROI i owns masks[offsets[i]:offsets[i + 1]]
+    x, y = masks['x'].astype(np.int64), masks['y'].astype(np.int64)
+    if len(masks) and (x.max() >= width or y.max() >= height):
+        raise ValueError(f'Pixel masks reach ({x.max()}, {y.max()}), outside the {width}x{height} field')
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return mask_matrix(rows, y * width + x, masks['weight'], len(offsets) - 1, height * width)
+
+
+def neuropil_mask_matrix(masks, offsets, height, width, neuropil_gap=2, min_pixels=350):
+    # for each ROI, the free pixels of the smallest disk around its centroid holding min_pixels of them
+    x, y = masks['x'].astype(np.int64), masks['y'].astype(np.int64)
+    occupied = np.zeros((height, width), dtype=bool)
+    occupied[y, x] = True
+    free = ~ndimage.binary_dilation(occupied, iterations=neuropil_gap) if neuropil_gap else ~occupied
+    rows, pixels = [], []
+    for roi, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if stop == start:
+            continue
+        cy, cx = y[start:stop].mean(), x[start:stop].mean()
+        radius = np.sqrt((stop - start) / np.pi) + neuropil_gap + 1
+        while True:
+            y0, y1 = max(int(cy - radius), 0), min(int(cy + radius) + 1, height)
+            x0, x1 = max(int(cx - radius), 0), min(int(cx + radius) + 1, width)
+            yy, xx = np.mgrid[y0:y1, x0:x1]
+            ring = free[y0:y1, x0:x1] & ((yy - cy) ** 2 + (xx - cx) ** 2 <= radius ** 2)
+            if ring.sum() >= min_pixels or radius > max(height, width):
+                break
+            radius *= 1.25
+        rows.append(np.full(ring.sum(), roi))
+        pixels.append(yy[ring] * width + xx[ring])
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    pixels = np.concatenate(pixels) if pixels else np.zeros(0, dtype=np.int64)
+    return mask_matrix(rows, pixels, np.ones(len(pixels)), len(offsets) - 1, height * width)
+
+
+def block_traces(scan, field, matrix, frame_provider, block):
+    # runs in a worker process: (frames, rois) traces of frames block[0]:block[1]
+    frames = (frame_provider or read_frame_block)(scan, field, *block)
+    frames = np.asarray(frames, dtype=np.float32).reshape(len(frames), -1)
+    return np.asarray(matrix @ frames.T).T
+
+
+def extract_traces(scan, masks, offsets, field=0, block_size=100, frame_provider=None, workers=None,
+                   neuropil_coefficient=0.7, neuropil_gap=2, neuropil_min_pixels=350, dtype=np.float32):
+    """(frames, rois) fluorescence traces of a scan field from the ROI pixel masks.
+
+    Returns (traces, corrected): corrected = traces - neuropil_coefficient * neuropil traces, or None
+    when neuropil_coefficient is None. Like estimate_motion, scan and frame_provider are sent to the
+    worker processes.
+    """
+    height, width = scan.field_heights[field], scan.field_widths[field]
+    offsets = np.asarray(offsets, dtype=np.int64)
+    num_rois = len(offsets) - 1
+    matrix = roi_mask_matrix(masks, offsets, height, width)
+    if neuropil_coefficient is not None:
+        # ROI and neuropil traces come out of the same product, stacked as 2 * num_rois rows
+        matrix = sparse.vstack([matrix, neuropil_mask_matrix(masks, offsets, height, width,
+                                                             neuropil_gap, neuropil_min_pixels)]).tocsr()
+
+    blocks = [(start, min(start + block_size, scan.num_frames)) for start in range(0, scan.num_frames, block_size)]
+    extract = partial(block_traces, scan, field, matrix, frame_provider)
+    traces = np.empty((scan.num_frames, matrix.shape[0]), dtype=dtype)
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        results = map(extract, blocks)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(extract, blocks)
+    try:
+        for (start, stop), block in zip(blocks, results):
+            traces[start:stop] = block
+    finally:
+        if workers != 1:
+            executor.shutdown()
+
+    if neuropil_coefficient is None:
+        return traces, None
+    roi_traces = np.ascontiguousarray(traces[:, :num_rois])
+    corrected = roi_traces - np.asarray(neuropil_coefficient, dtype=dtype) * traces[:, num_rois:]
+    return roi_traces, corrected